@@ -1,7 +1,17 @@
 import random
+import multiprocessing
+import queue
+import threading
+import traceback
+from functools import partial
 from deap import base, creator, tools
 from algorithm.models import IntersectUnionFitness, MyIndividual, \
-    create_individual_random, CrossoverGeometric, MutatorSimple, create_individual_heuristic1, FastIntersectUnionFitness
+    create_individual_random, CrossoverGeometric, MutatorSimple, create_individual_heuristic1, FastIntersectUnionFitness, \
+    create_population_heuristic1, CrossoverColumnGeometric
+from algorithm.population import optimize_cluster_population
+from algorithm.annealing import optimize_cluster_annealing
+from algorithm.parallel import shared_pool
+from algorithm.stopping import EarlyStopping
 from util import load_json, store_json, individual_to_json
 import util
 # Maximization fitness
@@ -9,50 +19,234 @@ import time
 import numpy as np
 from constants import MAX_RADIUS_OF_INFLUENCE
 from tqdm import tqdm
+from shapely.geometry import box
 
 creator.create("FitnessMax", base.Fitness, weights=(1.0,))
 creator.create("Individual", MyIndividual, fitness=creator.FitnessMax)
 
 
 def optimize_cluster(cluster, constraints, data, settings: dict = None):
+    """
+    Run the GA on one cluster (or the engine in settings["engine"]), returns the final population, the best individual and the report of
+    algorithm.stopping.EarlyStopping saying why and after how many generations and evaluations it stopped.
+    With settings["local_search"], e.g. LocalSearchSwap, the settings["local_search_elites"] best individuals
+    are improved by local search after every generation.
+    """
+    # Optionally evaluate fitness columns on a pool of settings["evaluation_workers"] processes,
+    # the pool of this process is reused by later calls
+    evaluate = settings["evaluate"]
+    if settings.get("evaluation_workers", 1) > 1 and getattr(evaluate, "pool", False) is None:
+        evaluate.pool = shared_pool(evaluate, settings["evaluation_workers"])
+        try:
+            return optimize_cluster(cluster, constraints, data, settings)
+        finally:
+            evaluate.pool = None
+
+    if settings.get("engine") == "population":
+        return optimize_cluster_population(cluster, constraints, data, settings)
+    if settings.get("engine") == "annealing":
+        return optimize_cluster_annealing(cluster, constraints, data, settings)
+
     toolbox = base.Toolbox()
 
     toolbox.register("individual", settings["create_individual"])
-    toolbox.register("population", tools.initRepeat, list, toolbox.individual)
+    if "create_population" in settings:
+        toolbox.register("population", lambda n: settings["create_population"](n))
+    else:
+        toolbox.register("population", tools.initRepeat, list, toolbox.individual)
     toolbox.register("evaluate", settings["evaluate"])
     toolbox.register("mate", settings["mate"])
     toolbox.register("mutate", settings["mutate"])
     toolbox.register("select", tools.selTournament, tournsize=settings["tournsize"])
     toolbox.register("clone", settings["clone"])
-    population = toolbox.population(n=settings["population_size"])
+    if hasattr(settings["evaluate"], "evaluate_population"):
+        toolbox.register("evaluate_population", settings["evaluate"].evaluate_population)
+    else:
+        toolbox.register("evaluate_population", lambda individuals: list(map(toolbox.evaluate, individuals)))
+    if "initial_population" in settings:
+        population = settings["initial_population"]
+    else:
+        population = toolbox.population(n=settings["population_size"])
 
-    for ind in population:
-        fit = toolbox.evaluate(ind)
+    # Only individuals whose schedule changed since their last evaluation are evaluated again
+    invalid = [ind for ind in population if not ind.valid]
+    fits = toolbox.evaluate_population(invalid)
+    best_individual = tools.selBest(population, 1)[0]
+    stopping = EarlyStopping.of(settings)
+    if not stopping.history:
+        stopping.update(best_individual.fitness, len(invalid))
 
     for gen in tqdm(range(settings["generations"]), disable=True):
+        if stopping.reason is not None:
+            break
         offspring = toolbox.select(population, len(population) - settings["elitism"])
         offspring = list(map(toolbox.clone, offspring))
 
         for child1, child2 in zip(offspring[::2], offspring[1::2]):
             if random.random() < settings["crossover_probability"]:
                 toolbox.mate(child1, child2)
-                child1.fitness = None
-                child2.fitness = None
 
         for mutant in offspring:
             if random.random() < settings["mutation_probability"]:
                 toolbox.mutate(mutant)
-                mutant.fitness = None
 
-        for ind in offspring:
-            fit = toolbox.evaluate(ind)
+        invalid = [ind for ind in offspring if not ind.valid]
+        fits = toolbox.evaluate_population(invalid)
         population = sorted(population, key=lambda x: x.fitness, reverse=True)
         population = population[:settings["elitism"]] + offspring
+
+        # Memetic step, polish the best individuals with settings["local_search"]
+        # Its evaluated columns count as 1/SUNDAYS of an individual each
+        evaluated = len(invalid)
+        if settings.get("local_search") is not None:
+            for ind in tools.selBest(population, settings.get("local_search_elites", 1)):
+                evaluated += settings["local_search"](ind, settings["evaluate"]) / ind.context.sundays
         best_individual = tools.selBest(population, 1)[0]
         print("Best fitness:", best_individual.fitness)
         # print(f"Population fitnesses: {[ind.fitness for ind in population]}")
         # print(f"Generation {gen}:  Fitness: {best_individual.fitness}")
-    return population, best_individual
+        stopping.update(best_individual.fitness, evaluated)
+    return population, best_individual, stopping.report()
+
+
+MIGRATION_TOPOLOGIES = {
+    "ring": lambda island, islands: [(island + 1) % islands],
+    "complete": lambda island, islands: [other for other in range(islands) if other != island],
+}
+
+
+class NeighbourFailed(Exception):
+    """Raised in an island whose neighbour failed, so it stops waiting for migrants."""
+
+
+def run_island(island, cluster, constraints, data, settings, inbox, outboxes, results, seed):
+    """
+    Process target of an island. When an island raises, it passes an error marker on to its neighbours,
+    which pass it on in turn, and puts its traceback on results in place of a population.
+    """
+    try:
+        evolve_island(island, cluster, constraints, data, settings, inbox, outboxes, results, seed)
+    except NeighbourFailed:
+        for outbox in outboxes:
+            outbox.put(None)
+    except BaseException:
+        for outbox in outboxes:
+            outbox.put(None)
+        results.put((island, None, traceback.format_exc()))
+
+
+def evolve_island(island, cluster, constraints, data, settings, inbox, outboxes, results, seed):
+    """
+    Evolve one sub-population, exchanging its best individuals with its neighbours between epochs.
+
+    Early stopping is tracked over the whole run of the island and only stops this island, the others
+    keep searching. A stopped island keeps its population and still takes part in the migrations until
+    the last epoch, so no neighbour waits on it forever.
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    interval = settings["migration_interval"]
+    epochs = [interval] * (settings["generations"] // interval)
+    if settings["generations"] % interval > 0 or len(epochs) == 0:
+        epochs.append(settings["generations"] % interval)
+    inbound = sum(island in MIGRATION_TOPOLOGIES[settings["migration_topology"]](other, settings["islands"])
+                  for other in range(settings["islands"]))
+
+    island_settings = dict(settings)
+    island_settings["stopping"] = stopping = EarlyStopping(settings)
+    population = None
+    for epoch, generations in enumerate(epochs):
+        island_settings["generations"] = generations
+        if population is not None:
+            island_settings["initial_population"] = population
+        population, best_individual, report = optimize_cluster(cluster, constraints, data, island_settings)
+        if epoch == len(epochs) - 1:
+            break
+
+        # Send copies of the best individuals to every neighbour and let immigrants replace the worst ones
+        population = sorted(population, key=lambda x: x.fitness, reverse=True)
+        migrants = population[:settings["migration_size"]]
+        for outbox in outboxes:
+            outbox.put(migrants)
+        immigrants = []
+        for _ in range(inbound):
+            inbound_migrants = inbox.get()
+            if inbound_migrants is None:
+                raise NeighbourFailed()
+            immigrants += inbound_migrants
+        if stopping.reason is not None:
+            continue
+        immigrants = sorted(immigrants, key=lambda x: x.fitness, reverse=True)[:len(population) - 1]
+        population = population[:len(population) - len(immigrants)] + immigrants
+    results.put((island, population, stopping.report()))
+
+
+def optimize_cluster_islands(cluster, constraints, data, settings: dict = None):
+    """
+    Island model version of optimize_cluster.
+
+    Runs settings["islands"] sub-populations of settings["population_size"] in separate processes and
+    every settings["migration_interval"] generations sends the settings["migration_size"] best individuals
+    of each island to its neighbours in settings["migration_topology"] ("ring" or "complete").
+    A settings["max_evaluations"] budget is split evenly between the islands. All settings have to be picklable.
+    """
+    islands = settings.get("islands", 1)
+    if islands <= 1:
+        return optimize_cluster(cluster, constraints, data, settings)
+
+    settings = dict({"migration_interval": 10, "migration_size": 2, "migration_topology": "ring"}, **settings)
+    if settings.get("max_evaluations") is not None:
+        settings["max_evaluations"] = settings["max_evaluations"] / islands
+    seeds = np.random.SeedSequence(random.randrange(2**32)).generate_state(islands)
+    context = multiprocessing.get_context()
+    inboxes = [context.Queue() for _ in range(islands)]
+    results = context.Queue()
+
+    processes = []
+    for island in range(islands):
+        outboxes = [inboxes[other] for other in MIGRATION_TOPOLOGIES[settings["migration_topology"]](island, islands)]
+        process = context.Process(target=run_island, args=(island, cluster, constraints, data, settings,
+                                                           inboxes[island], outboxes, results, int(seeds[island])))
+        process.start()
+        processes.append(process)
+
+    # A failing island reports its traceback instead of a population, then all islands are stopped
+    populations, reports = {}, {}
+    try:
+        while len(reports) < islands:
+            try:
+                island, island_population, island_report = results.get(timeout=1)
+            except queue.Empty:
+                crashed = [island for island, process in enumerate(processes) if process.exitcode not in (None, 0)]
+                if crashed:
+                    raise RuntimeError(f"Island {crashed[0]} exited with code {processes[crashed[0]].exitcode}")
+                continue
+            if island_population is None:
+                raise RuntimeError(f"Island {island} failed:\n{island_report}")
+            populations[island], reports[island] = island_population, island_report
+    except BaseException:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        raise
+    for process in processes:
+        process.join()
+
+    population = [ind for island in range(islands) for ind in populations[island]]
+    best_individual = tools.selBest(population, 1)[0]
+    # Islands stop on their own, the run only stopped early when all of them did
+    reasons = [reports[island]["reason"] for island in range(islands) if reports[island]["reason"] != "generations"]
+    report = {
+        "reason": reasons[0] if len(reasons) == islands else "generations",
+        "generations": max(report["generations"] for report in reports.values()),
+        "evaluations": sum(report["evaluations"] for report in reports.values()),
+        "initial_fitness": max(report["initial_fitness"] for report in reports.values()),
+        "best_fitness": float(best_individual.fitness),
+        "elapsed": max(report["elapsed"] for report in reports.values()),
+        "islands": [reports[island] for island in range(islands)],
+    }
+    return population, best_individual, report
 
 
 def main():
@@ -68,9 +262,10 @@ def main():
     # Example settings for the optimization process
     settings = {
         "create_individual": lambda: create_individual_heuristic1(cluster, constraints, data),
-        "evaluate": lambda ind: f_fitness(ind),
-        "mate": lambda ind1, ind2: crossover(ind1, ind2),
-        "mutate": lambda ind: mutator(ind),
+        "create_population": lambda size: create_population_heuristic1(cluster, constraints, data, size),
+        "evaluate": f_fitness,
+        "mate": crossover,
+        "mutate": mutator,
         "tournsize": 3,
         "clone": lambda ind: ind.copy(),
         "population_size": 50,
@@ -80,7 +275,8 @@ def main():
         "elitism": 1,
     }
 
-    p, best_individual = optimize_cluster(cluster, constraints, data, settings)
+    p, best_individual, report = optimize_cluster(cluster, constraints, data, settings)
+    print(f"Stopped after {report['generations']} generations: {report['reason']}")
     random_ind = create_individual_heuristic1(cluster, constraints, data)
 
     store_json(individual_to_json(random_ind), "results/random_individual.json")
@@ -106,13 +302,12 @@ def test():
     data_per_sunday = []
     data_per_sunday1 = []
     m = -9999
-    for sunday in range(rnd_ind.constraints["SUNDAYS"]):
+    for sunday in range(constraints["SUNDAYS"]):
         radii = solution_matrix[:, sunday]
-        coords = [rnd_ind.data[id_]["coordinates"] for id_ in rnd_ind.cluster]
+        coords = [data[id_]["coordinates"] for id_ in rnd_ind.cluster]
         boxes = util.fast_create_boxes(coords, radii)
-        other_boxes = [util.create_box(rnd_ind.data[id_]["coordinates"][1], rnd_ind.data[id_]
-                                       ["coordinates"][0], radius) for id_, radius in zip(rnd_ind.cluster, radii)]
-        other_boxes_ = np.array([box.bounds for box in other_boxes])
+        other_boxes = [util.create_box(data[id_]["coordinates"][0], data[id_]
+                                       ["coordinates"][1], radius) for id_, radius in zip(rnd_ind.cluster, radii)]
         union, intersect = util.fast_union_intersect(boxes)
         union1, intersect1 = util.union_intersect(other_boxes)
         m = max(m, abs(union - intersect - union1 + intersect1))
@@ -120,17 +315,116 @@ def test():
         data_per_sunday.append(union - intersect)
         data_per_sunday1.append(union1 - intersect1)
     print(f"Max diff: {m}")
-    print(f"Average diff: {np.average(np.abs(data_per_sunday) - np.average(data_per_sunday1))}")
+    print(f"Average diff: {np.average(np.abs(np.subtract(data_per_sunday, data_per_sunday1)))}")
+
+    # Sweep line against shapely on random boxes, half of them on an integer grid so that edges touch,
+    # boxes repeat and some have zero width or height
+    rng = np.random.default_rng(0)
+    m = 0
+    for size in (0, 1, 2, 3, 5, 10, 30):
+        for trial in range(20):
+            corners = rng.uniform(0, 10, (size, 2))
+            sides = rng.uniform(0, 4, (size, 2))
+            if trial % 2 == 1:
+                corners, sides = np.floor(corners / 2), np.floor(sides)
+            boxes = np.concatenate([corners, corners + sides], axis=1)
+            union, intersect = util.fast_union_intersect(boxes)
+            union1, intersect1 = util.union_intersect([box(*bounds) for bounds in boxes.tolist()])
+            m = max(m, abs(union - union1), abs(intersect - intersect1))
+    print(f"Max diff on random boxes: {m}")
     start = time.time()
     f1 = fitness(rnd_ind)
     end = time.time()
     print(f"Time taken for fitness calculation: {end - start} seconds")
     start = time.time()
-    f2 = f_fitness(rnd_ind)
+    f2 = f_fitness(MyIndividual(rnd_ind.context, rnd_ind.schedule.copy()))  # Not the Sundays cached by fitness
     end = time.time()
     print(f"Time taken for fast fitness calculation: {end - start} seconds")
     print(f"Difference in fitness: {f1[0] - f2[0]}")
 
 
+def test_island_stagnation():
+    """An island that stagnates must not stop a neighbour that is still improving."""
+    clusters = load_json("data/simple_cluster.json")
+    constraints = load_json("data/constraints.json")
+    data = load_json("data/sample_profit.json")
+
+    cluster = clusters[0]
+    settings = {
+        "create_individual": partial(create_individual_heuristic1, cluster, constraints, data),
+        "evaluate": FastIntersectUnionFitness(),
+        "mate": CrossoverColumnGeometric(0.2),
+        "mutate": MutatorSimple(0.6, 2),
+        "tournsize": 3,
+        "clone": MyIndividual.copy,
+        "population_size": 20,
+        "generations": 40,
+        "crossover_probability": 0.7,
+        "mutation_probability": 0.8,
+        "elitism": 1,
+        "islands": 2,
+        "migration_interval": 5,
+        "migration_size": 2,
+        "migration_topology": "ring",
+    }
+    # Island 0 has no variation and stagnates in its first epoch, island 1 keeps evolving
+    island_settings = [dict(settings, crossover_probability=0.0, mutation_probability=0.0, stagnation_generations=3),
+                       dict(settings, stagnation_generations=None)]
+
+    # Both islands run as threads of this process, queue.Queue has the interface of the process queues
+    inboxes = [queue.Queue(), queue.Queue()]
+    results = queue.Queue()
+    threads = [threading.Thread(target=run_island, args=(island, cluster, constraints, data, island_settings[island],
+                                                         inboxes[island], [inboxes[1 - island]], results, island))
+               for island in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    reports = {}
+    while not results.empty():
+        island, population, report = results.get()
+        assert population is not None, report
+        reports[island] = report
+
+    assert reports[0]["reason"] == "stagnation", reports[0]
+    assert reports[1]["reason"] == "generations", reports[1]
+    assert reports[1]["generations"] == settings["generations"], reports[1]
+    print(f"Stagnated island stopped after {reports[0]['generations']} generations, "
+          f"the other ran {reports[1]['generations']}")
+
+
+def benchmark():
+    clusters = load_json("data/simple_cluster.json")
+    constraints = load_json("data/constraints.json")
+    data = load_json("data/sample_profit.json")
+
+    cluster = clusters[0]
+    crossover = CrossoverGeometric(0.1)
+    mutator = MutatorSimple(0.5, 1)
+
+    for engine in ["deap", "population"]:
+        random.seed(0)
+        np.random.seed(0)
+        settings = {
+            "engine": engine,
+            "create_individual": lambda: create_individual_heuristic1(cluster, constraints, data),
+            "evaluate": FastIntersectUnionFitness(cluster, constraints, data),
+            "mate": crossover,
+            "mutate": mutator,
+            "tournsize": 3,
+            "clone": lambda ind: ind.copy(),
+            "population_size": 50,
+            "generations": 90,
+            "crossover_probability": 0.8,
+            "mutation_probability": 0.8,
+            "elitism": 1,
+        }
+        start = time.time()
+        p, best_individual, report = optimize_cluster(cluster, constraints, data, settings)
+        end = time.time()
+        print(f"Engine {engine}: {end - start} seconds, best fitness: {best_individual.fitness}")
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,75 @@
+import numpy as np
+from algorithm.models import random_swap_moves, score_swap_moves, apply_swap_moves
+from algorithm.stopping import EarlyStopping
+
+
+def initial_temperature(individual, fitness, moves):
+    """Temperature at which an average worsening move is accepted with probability 1/2."""
+    stores, sources, targets = random_swap_moves(individual, moves)
+    if len(stores) == 0:
+        return 1.0
+    deltas = score_swap_moves(individual, fitness, stores, sources, targets)[2] / individual.context.sundays
+    worse = -deltas[deltas < 0]
+    return worse.mean() / np.log(2) if len(worse) > 0 else 1e-3 * max(abs(individual.fitness), 1.0)
+
+
+def anneal_swaps(individual, fitness, moves, batch, temperature):
+    """
+    Metropolis steps with random swap moves at a fixed temperature, changes an evaluated individual in place.
+
+    Moves are drawn and scored batch at a time and accepted in their drawn order, a move whose columns an
+    earlier accepted move of its batch changed is dropped. Returns the number of evaluated columns.
+    """
+    evaluated = 0
+    for start in range(0, moves, batch):
+        stores, sources, targets = random_swap_moves(individual, min(batch, moves - start))
+        if len(stores) == 0:
+            break
+        source_values, target_values, deltas = score_swap_moves(individual, fitness, stores, sources, targets)
+        evaluated += 2 * len(stores)
+        deltas = deltas / individual.context.sundays
+        accepted = np.random.random(len(stores)) < np.exp(np.minimum(deltas, 0) / temperature)
+        apply_swap_moves(individual, stores, sources, targets, source_values, target_values, np.flatnonzero(accepted))
+    return evaluated
+
+
+def optimize_cluster_annealing(cluster, constraints, data, settings: dict = None):
+    """
+    Single trajectory simulated annealing version of optimize_cluster driven by the same settings dict.
+
+    Every generation tries settings["annealing_moves"] (default 64) swap moves, each scored on the two
+    Sundays it touches, and cools geometrically from settings["initial_temperature"] (estimated from the
+    start when missing) to settings["final_temperature_ratio"] (default 1e-3) of it over all generations.
+    Evaluations are reported in individuals, a column counts as 1/SUNDAYS of one.
+    """
+    fitness = settings["evaluate"]
+    if "initial_population" in settings:
+        for ind in settings["initial_population"]:
+            if not ind.valid or ind.sunday_fitness is None:
+                fitness(ind)
+        current = max(settings["initial_population"], key=lambda x: x.fitness).copy()
+    else:
+        current = settings["create_individual"]()
+    if not current.valid or current.sunday_fitness is None:
+        fitness(current)
+    best_individual = current.copy()
+    sundays = current.context.sundays
+
+    moves = settings.get("annealing_moves", 64)
+    batch = settings.get("annealing_batch", 16)
+    temperature = settings.get("initial_temperature") or initial_temperature(current, fitness, batch)
+    cooling = settings.get("final_temperature_ratio", 1e-3) ** (1 / max(settings["generations"], 1))
+    stopping = EarlyStopping.of(settings)
+    if not stopping.history:
+        stopping.update(best_individual.fitness, 1)
+
+    for gen in range(settings["generations"]):
+        if stopping.reason is not None:
+            break
+        evaluated = anneal_swaps(current, fitness, moves, batch, temperature)
+        temperature *= cooling
+        if current.fitness > best_individual.fitness:
+            best_individual = current.copy()
+        print("Best fitness:", best_individual.fitness)
+        stopping.update(best_individual.fitness, evaluated / sundays)
+    return [best_individual], best_individual, stopping.report()
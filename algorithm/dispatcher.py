@@ -1,34 +1,319 @@
-from algorithm.algorithms import optimize_cluster
+from algorithm.algorithms import optimize_cluster, optimize_cluster_islands
+from algorithm.scheduler import GenerationScheduler
 from tools.generate_clusters import make_clusters
 from constants import MAX_RADIUS_OF_INFLUENCE
-from util import load_json, store_json, individual_to_json, haversine
-from algorithm.models import FastIntersectUnionFitness, CrossoverGeometric, MutatorSimple, create_individual_based_on_others_heuristic1, CrossoverColumnGeometric, create_individual_random
+from util import load_json, store_json, individual_to_json, store_pickle, load_pickle, fast_latlon_to_xy, \
+    haversine_one_to_many, interaction_pairs, connected_components
+from algorithm.models import FastIntersectUnionFitness, CrossoverGeometric, MutatorSimple, create_individual_based_on_others_heuristic1, CrossoverColumnGeometric, create_individual_random, create_population_based_on_others_heuristic1, MyIndividual, LocalSearchSwap, \
+    SparseIntersectUnionFitness
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import argparse
 import datetime
 import os
 import numpy as np
 import random
 
-OUTDIR = f'results/{datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}'
-os.makedirs(OUTDIR, exist_ok=True)
+# Constraints and data of the current run, set once per worker process by init_worker
+WORKER_STATE = {}
+
+# Dispatcher state stored in the results directory after every finished cluster, see --resume
+CHECKPOINT_FILE = "checkpoint.pkl"
+
+
+def make_settings(cluster, constraints, data, seeds, generations, overrides=None):
+    """GA settings for one cluster, built only from picklable callables and updated with overrides."""
+    settings = {
+        "create_individual": partial(create_individual_based_on_others_heuristic1, cluster[::], constraints, data, seeds),
+        "create_population": partial(create_population_based_on_others_heuristic1, cluster[::], constraints, data, seeds),
+        "evaluate": FastIntersectUnionFitness(cluster, constraints, data),
+        "mate": CrossoverColumnGeometric(0.2),
+        "mutate": MutatorSimple(0.6, 2),
+        "tournsize": 3,
+        "clone": MyIndividual.copy,
+        "population_size": 50,
+        "generations": generations,
+        "crossover_probability": 0.7,
+        "mutation_probability": 0.8,
+        "elitism": 1,
+    }
+    settings.update(overrides or {})
+    return settings
+
+
+def init_worker(constraints, data, overrides=None):
+    WORKER_STATE["constraints"] = constraints
+    WORKER_STATE["data"] = data
+    WORKER_STATE["overrides"] = overrides
+
+
+def optimize_cluster_task(cluster, seeds, generations, seed, task_settings=None):
+    """
+    Optimize one cluster inside a worker, seeded so results do not depend on the worker count.
+    task_settings (engine, islands) override the settings for this cluster only.
+    Returns the best individual and the stopping report of the run.
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    constraints, data = WORKER_STATE["constraints"], WORKER_STATE["data"]
+    settings = make_settings(cluster, constraints, data, seeds, generations, WORKER_STATE["overrides"])
+    settings.update(task_settings or {})
+    if settings.get("islands", 1) > 1:
+        p, best_individual, report = optimize_cluster_islands(cluster, constraints, data, settings)
+    else:
+        p, best_individual, report = optimize_cluster(cluster, constraints, data, settings)
+    return best_individual, report
+
+
+def store_interaction_graph(data, max_radius):
+    """
+    Pairs of stores whose boxes can overlap with radii of at most max_radius, i.e. whose projected coordinates
+    differ by less than 2 * max_radius on both axes. Returns the index of every store id, (first, second,
+    distance) arrays of the pairs with their haversine distances and the connected component of every store.
+    Stores of different components never share any area, whatever the schedule.
+    """
+    ids = list(data.keys())
+    lon, lat = np.array([data[id_]["coordinates"] for id_ in ids], dtype=float).reshape(-1, 2).T
+    x, y = fast_latlon_to_xy(lat, lon)
+    first, second = interaction_pairs(x, y, 2 * max_radius)
+    distances = haversine_one_to_many(lat[first], lon[first], lat[second], lon[second])
+    store_index = {id_: index for index, id_ in enumerate(ids)}
+    return store_index, (first, second, distances), connected_components(first, second, len(ids))
+
+
+def cluster_adjacency(clusters, store_index, graph):
+    """For every cluster, the distance to each cluster it shares an edge of the graph with."""
+    firsts, seconds, distances = graph
+    labels = np.full(len(store_index), -1)
+    for index, cluster in enumerate(clusters):
+        labels[[store_index[store_id] for store_id in cluster]] = index
+    first_labels, second_labels = labels[firsts], labels[seconds]
+    between = (first_labels != second_labels) & (first_labels >= 0) & (second_labels >= 0)
+    low = np.minimum(first_labels[between], second_labels[between])
+    high = np.maximum(first_labels[between], second_labels[between])
+
+    # Closest pair of stores of every two neighbouring clusters, the first of each pair after sorting
+    keys = low * len(clusters) + high
+    order = np.lexsort((distances[between], keys))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = keys[order][1:] != keys[order][:-1]
+    adjacency = [{} for _ in clusters]
+    for a, b, distance in zip(low[order][first].tolist(), high[order][first].tolist(),
+                              distances[between][order][first].tolist()):
+        adjacency[a][b] = adjacency[b][a] = distance
+    return adjacency
+
+
+def merge_clusters(clusters, store_index, graph, join_amount):
+    """
+    Merge clusters picked in random order with their join_amount - 1 nearest remaining neighbours in the
+    interaction graph. Returns groups of merged cluster indices, a cluster whose neighbours were all taken
+    by earlier groups being a group of its own, and the clusters without any neighbour, which are whole
+    components and final.
+    """
+    adjacency = cluster_adjacency(clusters, store_index, graph)
+    remaining = list(range(len(clusters)))
+    position = list(range(len(clusters)))
+    alive = [True] * len(clusters)
+
+    def remove(index):
+        last = remaining.pop()
+        if last != index:
+            remaining[position[index]] = last
+            position[last] = position[index]
+        alive[index] = False
+
+    groups, finished = [], []
+    while len(remaining) > 0:
+        chosen = random.choice(remaining)
+        remove(chosen)
+        if len(adjacency[chosen]) == 0:
+            finished.append(chosen)
+            continue
+        nearest = sorted((distance, other) for other, distance in adjacency[chosen].items()
+                         if alive[other])[:join_amount - 1]
+        group = [chosen] + [other for _, other in nearest]
+        for other in group[1:]:
+            remove(other)
+        groups.append(group)
+    return groups, finished
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Number of processes optimizing clusters in parallel, 1 runs everything in this process")
+    parser.add_argument("--islands", type=int, default=1,
+                        help="Number of island sub-populations used for large clusters, 1 disables the island model")
+    parser.add_argument("--island-min-size", type=int, default=30,
+                        help="Clusters with at least this many stores use the island model")
+    parser.add_argument("--migration-interval", type=int, default=10,
+                        help="Generations between migrations of the island model")
+    parser.add_argument("--migration-topology", choices=["ring", "complete"], default="ring")
+    parser.add_argument("--evaluation-workers", type=int, default=1,
+                        help="Processes evaluating the fitness of each cluster, useful when clusters are few but large")
+    parser.add_argument("--stagnation-generations", type=int, default=50,
+                        help="Stop a cluster when its best fitness did not improve over this many generations")
+    parser.add_argument("--min-improvement", type=float, default=0.0,
+                        help="Relative improvement over the stagnation window that still counts as progress")
+    parser.add_argument("--max-evaluations", type=int, default=None,
+                        help="Stop a cluster after this many fitness evaluations")
+    parser.add_argument("--time-budget", type=float, default=None,
+                        help="Stop a cluster after this many seconds")
+    parser.add_argument("--local-search-moves", type=int, default=0,
+                        help="Swap moves tried on each elite per generation by the memetic local search, 0 disables it")
+    parser.add_argument("--local-search-elites", type=int, default=1,
+                        help="Number of best individuals improved by the local search")
+    parser.add_argument("--annealing-max-size", type=int, default=0,
+                        help="Clusters with at most this many stores are solved by simulated annealing instead of the GA")
+    parser.add_argument("--budget-evaluations", type=int, default=None,
+                        help="Fitness evaluations for the whole run, split over meta steps and clusters by the scheduler")
+    parser.add_argument("--budget-seconds", type=float, default=None,
+                        help="Wall-clock seconds for the whole run, split over meta steps and clusters by the scheduler")
+    parser.add_argument("--data", default="data/one_cluster_subset.json",
+                        help="Stores to schedule, e.g. data/rawdata.json for all of them")
+    parser.add_argument("--sparse-fitness", action="store_true",
+                        help="Evaluate the fitness through the sparse neighbour list of the stores, "
+                             "for clusters of many stores spread far apart")
+    parser.add_argument("--single-model", action="store_true",
+                        help="Optimize all stores as one cluster with the sparse fitness instead of merging clusters")
+    parser.add_argument("--resume", default=None, metavar="RESULTS_DIR",
+                        help="Continue an interrupted run from its checkpoint, with the options of that run "
+                             "except --workers and --evaluation-workers")
+    args = parser.parse_args()
+    resumed = None
+    if args.resume is not None:
+        resumed = load_pickle(os.path.join(args.resume, CHECKPOINT_FILE))
+        args = argparse.Namespace(**dict(resumed["args"], resume=args.resume, workers=args.workers,
+                                         evaluation_workers=args.evaluation_workers))
+    overrides = {
+        "evaluation_workers": args.evaluation_workers,
+        "stagnation_generations": args.stagnation_generations,
+        "min_improvement": args.min_improvement,
+        "max_evaluations": args.max_evaluations,
+        "time_budget": args.time_budget,
+        "local_search": LocalSearchSwap(args.local_search_moves) if args.local_search_moves > 0 else None,
+        "local_search_elites": args.local_search_elites,
+    }
+    if args.sparse_fitness or args.single_model:
+        overrides["evaluate"] = SparseIntersectUnionFitness()
+    island_settings = {
+        "islands": args.islands,
+        "migration_interval": args.migration_interval,
+        "migration_size": 2,
+        "migration_topology": args.migration_topology,
+    }
+
     constraints = load_json("data/constraints.json")
-    data = load_json("data/one_cluster_subset.json")
+    data = load_json(args.data)
     JOIN_CLUSTER_AMOUNT = 3
     GENERATION_PLAN = [500, 30, 10] + [2]*20
-    clusters = make_clusters(data, max_in_cluster=10, max_distance=MAX_RADIUS_OF_INFLUENCE)
+    store_index, interaction_graph, components = store_interaction_graph(data, MAX_RADIUS_OF_INFLUENCE)
+    component_sizes = np.bincount(components)
+    print(f"[COMPONENTS] {len(component_sizes)} independent components of up to {component_sizes.max()} stores, "
+          f"{np.sum(component_sizes == 1)} of them single stores")
+
+    init_worker(constraints, data, overrides)
+    executor = None
+    if args.workers > 1:
+        executor = ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                                       initargs=(constraints, data, overrides))
 
-    ctr = 0
-    current_individuals = [None] * len(clusters)
-    random_sol = create_individual_random(list(data.keys()), constraints, data)
-    store_json(individual_to_json(random_sol), f"{OUTDIR}\\random_start.json")
-    final_individuals = []
+    if resumed is not None:
+        OUTDIR = args.resume
+        scheduler = resumed["scheduler"]
+        scheduler.workers = args.workers
+        scheduler.restart_clock()
+        ctr = resumed["step"]
+        clusters = resumed["clusters"]
+        current_individuals = resumed["current_individuals"]
+        final_individuals = resumed["final_individuals"]
+        random.setstate(resumed["random_state"][0])
+        np.random.set_state(resumed["random_state"][1])
+    else:
+        OUTDIR = f'results/{datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")}'
+        os.makedirs(OUTDIR, exist_ok=True)
+        # GENERATION_PLAN is used as is without a budget, otherwise it only weighs the meta steps
+        scheduler = GenerationScheduler(GENERATION_PLAN, args.budget_evaluations, args.budget_seconds, args.workers,
+                                        join_amount=JOIN_CLUSTER_AMOUNT)
+        if args.single_model:
+            clusters = [list(data.keys())]
+        else:
+            clusters = make_clusters(data, max_in_cluster=10, max_distance=MAX_RADIUS_OF_INFLUENCE)
+        ctr = 0
+        current_individuals = [None] * len(clusters)
+        random_sol = create_individual_random(list(data.keys()), constraints, data)
+        store_json(individual_to_json(random_sol), os.path.join(OUTDIR, "random_start.json"))
+        final_individuals = []
     while True:
         print(f"[META STEP] {ctr}")
         ctr += 1
         future_individuals = []
-        store_json(clusters, f"{OUTDIR}\\metastep{ctr-1}_clusters.json")
+        store_json(clusters, os.path.join(OUTDIR, f"metastep{ctr-1}_clusters.json"))
+
+        # Clusters are independent, optimize all non-trivial ones in parallel and collect them in order.
+        # Large clusters run as island models from this process, their islands are processes of their own.
+        # Small clusters are cheaper to solve with a single simulated annealing trajectory.
+        tasks = [index for index, cluster in enumerate(clusters) if len(cluster) > 1]
+        if resumed is not None:
+            # Continue the meta step of the checkpoint without recomputing its finished clusters
+            seeds, results, allocation = resumed["seeds"], resumed["results"], resumed["allocation"]
+            resumed = None
+        else:
+            seeds = {index: random.randrange(2**32) for index in tasks}
+            results = {}
+            allocation = scheduler.allocate(ctr - 1, clusters, tasks)
+        print(f"[SCHEDULE] {sum(budget['generations'] for budget in allocation.values())} generations "
+              f"for {len(tasks)} clusters, used {scheduler.used_evaluations:.0f} evaluations "
+              f"and {scheduler.used_seconds:.0f} seconds so far")
+
+        island_tasks = [index for index in tasks if args.islands > 1 and len(clusters[index]) >= args.island_min_size]
+        task_settings = {}
+        for index in tasks:
+            task_settings[index] = {key: allocation[index][key] for key in ("max_evaluations", "time_budget")
+                                    if allocation[index][key] is not None}
+            if index in island_tasks:
+                task_settings[index].update(island_settings)
+            elif len(clusters[index]) <= args.annealing_max_size:
+                task_settings[index]["engine"] = "annealing"
+        futures = {}
+        if executor is not None:
+            futures = {index: executor.submit(optimize_cluster_task, clusters[index], current_individuals[index],
+                                              allocation[index]["generations"], seeds[index], task_settings[index])
+                       for index in tasks if index not in island_tasks and index not in results}
+
+        # Everything needed to redo this meta step, written again whenever a cluster finishes
+        random_state = (random.getstate(), np.random.get_state())
+        checkpoint = {
+            "args": {key: value for key, value in vars(args).items() if key != "resume"},
+            "step": ctr - 1,
+            "clusters": clusters,
+            "current_individuals": current_individuals,
+            "final_individuals": final_individuals,
+            "seeds": seeds,
+            "results": results,
+            "random_state": random_state,
+            "allocation": allocation,
+            "scheduler": scheduler,
+        }
+        store_pickle(checkpoint, os.path.join(OUTDIR, CHECKPOINT_FILE))
+        for index in tasks:
+            if index in results:
+                continue
+            if index in futures:
+                results[index] = futures[index].result()
+            else:
+                results[index] = optimize_cluster_task(clusters[index], current_individuals[index],
+                                                       allocation[index]["generations"], seeds[index],
+                                                       task_settings[index])
+            scheduler.record(clusters[index], results[index][1], allocation[index])
+            store_pickle(checkpoint, os.path.join(OUTDIR, CHECKPOINT_FILE))
+        store_json({str(index): budget for index, budget in allocation.items()},
+                   os.path.join(OUTDIR, f"metastep{ctr-1}_allocation.json"))
+
+        # Tasks run in this process reseed the generators, continue from the state saved in the checkpoint
+        random.setstate(random_state[0])
+        np.random.set_state(random_state[1])
         for index, cluster in enumerate(clusters):
 
             if len(cluster) == 1:  # Trivial case
@@ -37,80 +322,30 @@ if __name__ == "__main__":
                 future_individuals.append(ind)
                 continue
 
-            f_fitness = FastIntersectUnionFitness(cluster, constraints, data)
-            crossover = CrossoverColumnGeometric(0.2)
-            mutator = MutatorSimple(0.6, 2)
-            settings = {
-                "create_individual": lambda: create_individual_based_on_others_heuristic1(cluster[::], constraints, data, current_individuals[index]),
-                "evaluate": lambda ind: f_fitness(ind),
-                "mate": lambda ind1, ind2: crossover(ind1, ind2),
-                "mutate": lambda ind: mutator(ind),
-                "tournsize": 3,
-                "clone": lambda ind: ind.copy(),
-                "population_size": 50,
-                "generations": GENERATION_PLAN[ctr-1],
-                "crossover_probability": 0.7,
-                "mutation_probability": 0.8,
-                "elitism": 1,
-            }
-
-            p, best_individual = optimize_cluster(cluster, constraints, data, settings)
-            store_json(individual_to_json(best_individual), f"{OUTDIR}\\metastep{ctr-1}_step{index}.json")
-            print(f"Finished step {ctr-1}_{index}, best fitness: {best_individual.fitness}")
+            best_individual, report = results[index]
+            store_json(individual_to_json(best_individual), os.path.join(OUTDIR, f"metastep{ctr-1}_step{index}.json"))
+            print(f"Finished step {ctr-1}_{index}, best fitness: {best_individual.fitness}, stopped after "
+                  f"{report['generations']}/{allocation[index]['generations']} generations ({report['reason']})")
             future_individuals.append(best_individual)
-        if len(clusters) == 1:
+        if len(clusters) <= 1:
             final_individuals += future_individuals
             break
-        new_clusters = []
-        clusters_copy = clusters[::]
-        while len(clusters_copy) > 0:
-            random_one = random.choice(clusters_copy)
-            distances = []
-            for other in clusters_copy:
-                mindist = 1e10
-                minother = None
-                for first_id in random_one:
-                    for second_id in other:
-                        lon1, lat1 = data[first_id]["coordinates"]
-                        lon2, lat2 = data[second_id]["coordinates"]
-
-                        dist = haversine(lat1, lon1, lat2, lon2)
-                        if dist < mindist:
-                            mindist = dist
-                            minother = second_id
-                distances.append((other, mindist))
-            distances.sort(key=lambda x: x[1])
-            distances = distances[:min(JOIN_CLUSTER_AMOUNT, len(distances))]
-            if distances[1][1] > MAX_RADIUS_OF_INFLUENCE:
-                clust = distances[0][0]
-                clusters_copy.remove(clust)
-                for ind in future_individuals:
-                    for store_id in ind.cluster:
-                        if store_id in clust:
-                            final_individuals.append(ind)
-                            break
-                continue
 
-            new_cluster = []
-            for other, _ in distances:
-                new_cluster += other
-            new_clusters.append(new_cluster)
-            for other, _ in distances:
-                clusters_copy.remove(other)
-
-        current_individuals = []
-        for index, cluster in enumerate(new_clusters):
-            current_individuals.append([])
-            for other_ind in future_individuals:
-                for store_id in other_ind.cluster:
-                    if store_id in cluster:
-                        current_individuals[index].append(other_ind)
-                        break
-
-        clusters = new_clusters
+        # Clusters that cover a whole interaction component are final, the others are merged with neighbours
+        groups, finished = merge_clusters(clusters, store_index, interaction_graph, JOIN_CLUSTER_AMOUNT)
+        print(f"[MERGE] {len(finished)} clusters are whole components, {len(groups)} clusters left")
+        final_individuals += [future_individuals[index] for index in finished]
+        current_individuals = [[future_individuals[index] for index in sorted(group)] for group in groups]
+        clusters = [[store_id for index in group for store_id in clusters[index]] for group in groups]
+        if len(clusters) == 0:
+            break
 
     giga_ind = create_individual_based_on_others_heuristic1(
         list(data.keys()), constraints, data, final_individuals)
-    store_json(individual_to_json(giga_ind), f"{OUTDIR}\\metastep{ctr-1}_giga.json")
-    store_json(giga_ind.cluster, f"{OUTDIR}\\giga_cluster.json")
+    store_json(individual_to_json(giga_ind), os.path.join(OUTDIR, f"metastep{ctr-1}_giga.json"))
+    store_json(giga_ind.cluster, os.path.join(OUTDIR, "giga_cluster.json"))
+    store_json(scheduler.summary(), os.path.join(OUTDIR, "allocation.json"))
+    print(f"[SCHEDULE] Used {scheduler.used_evaluations:.0f} evaluations and {scheduler.used_seconds:.0f} seconds")
+    if executor is not None:
+        executor.shutdown()
     # Maybe don't join if distance is too big, maybe 2x max radius of influence GG
@@ -1,290 +1,614 @@
 import random
+from collections import OrderedDict
 from deap import base, creator, tools
 import numpy as np
 from shapely.geometry import box
-from util import create_box, union_intersect, fast_create_boxes, fast_union_intersect, haversine
+from util import create_box, union_intersect, fast_latlon_to_xy, batch_create_boxes, batch_union_intersect, haversine, \
+    fast_union_intersect, interaction_pairs, connected_components
 from constants import MAX_RADIUS_OF_INFLUENCE
 
 
-class MyIndividual:
+class ProblemContext:
+    """Read-only arrays describing one cluster, built once and shared by all of its individuals."""
+    __slots__ = ("cluster", "index", "sundays", "max_works", "coordinates", "x", "y", "populations",
+                 "locked", "forbidden", "neighbour_pairs")
+
+    # Recently used contexts, least recently used first. Bounded so that the clusters of earlier meta steps
+    # do not keep their contexts, constraints and data alive for the whole run
+    _contexts = OrderedDict()
+    max_contexts = 128
+
     def __init__(self, cluster, constraints, data):
-        self.cluster = cluster
-        self.constraints = constraints
-        self.data = data
+        self.cluster = list(cluster)
+        self.index = {id_: index for index, id_ in enumerate(self.cluster)}
+        self.sundays = constraints["SUNDAYS"]
+        self.max_works = constraints["MAX_WORKS"]
+
+        # (stores, 2) array of [lon, lat] and the projected coordinates used by the fitness
+        self.coordinates = np.array([data[id_]["coordinates"] for id_ in self.cluster], dtype=np.float64)
+        self.x, self.y = fast_latlon_to_xy(self.coordinates[:, 1], self.coordinates[:, 0])
+        self.populations = np.array([data[id_]["user_ratings_total"] for id_ in self.cluster], dtype=np.float64)
+
+        # locked are the works Sundays, forbidden the doesnt_work Sundays of every store
+        self.locked = np.zeros((len(self.cluster), self.sundays), dtype=bool)
+        self.forbidden = np.zeros((len(self.cluster), self.sundays), dtype=bool)
+        for index, id_ in enumerate(self.cluster):
+            self.locked[index, constraints[id_]["works"]] = True
+            self.forbidden[index, constraints[id_]["doesnt_work"]] = True
+
+        for array in (self.coordinates, self.x, self.y, self.populations, self.locked, self.forbidden):
+            array.flags.writeable = False
+
+        # Pairs of stores whose boxes can overlap, computed on first use by SparseIntersectUnionFitness
+        self.neighbour_pairs = None
+
+    @classmethod
+    def of(cls, cluster, constraints, data):
+        """Return the shared context of a cluster, building it on first use."""
+        key = (tuple(cluster), id(constraints), id(data))
+        entry = cls._contexts.get(key)
+        if entry is None or entry[0] is not constraints or entry[1] is not data:
+            entry = (constraints, data, cls(cluster, constraints, data))
+            cls._contexts[key] = entry
+            while len(cls._contexts) > cls.max_contexts:
+                cls._contexts.popitem(last=False)
+        else:
+            cls._contexts.move_to_end(key)
+        return entry[2]
+
+    def __len__(self):
+        return len(self.cluster)
+
+
+class MyIndividual:
+    __slots__ = ("context", "schedule", "fitness", "sunday_fitness", "dirty")
+
+    def __init__(self, context, schedule=None):
+        self.context = context
         self.fitness = None
 
-        self.works = [[] for _ in range(len(cluster))]
-        self.model = [[] for _ in range(len(cluster))]
-        self.antimodel = [[] for _ in range(len(cluster))]
-        self.big_matrix = np.zeros((len(cluster), constraints["SUNDAYS"]))
+        # schedule[store][sunday] is True when the store works on that Sunday, works entries included
+        if schedule is None:
+            schedule = np.zeros((len(context), context.sundays), dtype=bool)
+        self.schedule = schedule
+
+        # Cached per-Sunday fitness contributions and the Sundays changed since they were computed
+        self.sunday_fitness = None
+        self.dirty = set()
+
+    @property
+    def cluster(self):
+        return self.context.cluster
+
+    @property
+    def model_mask(self):
+        """Sundays chosen by the optimization, works entries excluded."""
+        return self.schedule & ~self.context.locked
+
+    @property
+    def antimodel_mask(self):
+        """Sundays that could still be chosen by the optimization."""
+        return ~(self.schedule | self.context.locked | self.context.forbidden)
+
+    @property
+    def works(self):
+        return [np.flatnonzero(row).tolist() for row in self.context.locked]
+
+    @property
+    def model(self):
+        return [np.flatnonzero(row).tolist() for row in self.model_mask]
+
+    @property
+    def antimodel(self):
+        return [np.flatnonzero(row).tolist() for row in self.antimodel_mask]
+
+    @property
+    def big_matrix(self):
+        return self.schedule * self.context.populations[:, None]
+
+    @property
+    def valid(self):
+        """True when fitness is up to date, operators have to mark the Sundays they change with mark_dirty."""
+        return self.fitness is not None and not self.dirty
+
+    def mark_dirty(self, *sundays):
+        self.dirty.update(int(sunday) for sunday in sundays)
 
     def copy(self):
-        new_ind = MyIndividual(self.cluster, self.constraints, self.data)
-
-        new_ind.works = [work[::] for work in self.works]
-        new_ind.model = [model[::] for model in self.model]
-        new_ind.antimodel = [antimodel[::] for antimodel in self.antimodel]
-        new_ind.big_matrix = self.big_matrix.copy()
-        if hasattr(self, "fitness"):
-            new_ind.fitness = self.fitness.copy()
+        new_ind = MyIndividual(self.context, self.schedule.copy())
+        new_ind.fitness = self.fitness
+        if self.sunday_fitness is not None:
+            new_ind.sunday_fitness = self.sunday_fitness.copy()
+        new_ind.dirty = set(self.dirty)
         return new_ind
 
     def __repr__(self):
         return f"{self.works + self.model}"
 
 
-def create_individual_random(cluster, constraints, data):
-    # just like random init
-    ind = MyIndividual(cluster, constraints, data)
-    for index, id_ in enumerate(cluster):
-        ind.works[index] = constraints[id_]["works"]
-        for i in range(constraints["SUNDAYS"]):
-            if i not in ind.works[index] and i not in constraints[id_]["doesnt_work"]:
-                ind.antimodel[index].append(i)
+def random_pick(mask):
+    """Index of a uniformly random True entry along the last axis of mask, rows without any are arbitrary."""
+    return np.argmax(np.where(mask, np.random.random(mask.shape), -1.0), axis=-1)
 
-        while len(ind.model[index]) + len(ind.works[index]) < constraints["MAX_WORKS"]:
-            rnd = random.randint(0, len(ind.antimodel[index]) - 1)
-            elem = ind.antimodel[index][rnd]
-            ind.model[index].append(elem)
-            ind.antimodel[index].pop(rnd)
 
-            ind.big_matrix[index][elem] = ind.data[id_]["user_ratings_total"]  # Put model entries in the big matrix
+def fill_schedules_to_max_works(context, schedules):
+    """Add random allowed Sundays to every store of the schedules until it works exactly MAX_WORKS Sundays."""
+    missing = context.max_works - schedules.sum(axis=2)
+    candidates = ~(schedules | context.locked | context.forbidden)
+    keys = np.where(candidates, np.random.random(schedules.shape), 2.0)
+    ranks = np.argsort(np.argsort(keys, axis=2), axis=2)
+    schedules |= candidates & (ranks < missing[:, :, None])
 
-        for w in ind.works[index]:
-            ind.big_matrix[index][w] = ind.data[id_]["user_ratings_total"]  # Put works entries in the big matrix
-    return ind
 
+def create_schedules_heuristic1(context, size):
+    """Build size schedules at once: cover every Sunday without work first, then fill to MAX_WORKS."""
+    schedules = np.repeat(context.locked[None], size, axis=0)
+    works_count = schedules.sum(axis=2)
+    feasible = ~(context.locked | context.forbidden)
+    sundays_that_have_work = context.locked.any(axis=0)
 
-def create_individual_heuristic1(cluster, constraints, data):
-    ind = MyIndividual(cluster, constraints, data)
-    sundays_that_have_work = set()
-    for index, id_ in enumerate(cluster):
-        ind.works[index] = constraints[id_]["works"]
-        sundays_that_have_work.update(ind.works[index])
-        for i in range(constraints["SUNDAYS"]):
-            if i not in ind.works[index] and i not in constraints[id_]["doesnt_work"]:
-                ind.antimodel[index].append(i)
-    for sunday in range(constraints["SUNDAYS"]):
-        if sunday in sundays_that_have_work:
-            continue
-        for index, id_ in enumerate(np.random.permutation(cluster)):
-            if sunday in ind.antimodel[index] and len(ind.model[index]) + len(ind.works[index]) < constraints["MAX_WORKS"]:
-                ind.model[index].append(sunday)
-                ind.antimodel[index].remove(sunday)
-                ind.big_matrix[index][sunday] = data[id_]["user_ratings_total"]
-                break
+    # Give every Sunday without work to a random store that may still work on it, in every schedule at once
+    for sunday in np.flatnonzero(~sundays_that_have_work):
+        candidates = feasible[None, :, sunday] & (works_count < context.max_works)
+        ind_indices = np.flatnonzero(candidates.any(axis=1))
+        store_indices = random_pick(candidates[ind_indices])
+        schedules[ind_indices, store_indices, sunday] = True
+        works_count[ind_indices, store_indices] += 1
+
+    fill_schedules_to_max_works(context, schedules)
+    return schedules
 
-    for index, id_ in enumerate(cluster):
-        while len(ind.model[index]) + len(ind.works[index]) < constraints["MAX_WORKS"]:
-            rnd = random.randint(0, len(ind.antimodel[index]) - 1)
-            elem = ind.antimodel[index][rnd]
-            ind.model[index].append(elem)
-            ind.antimodel[index].pop(rnd)
 
-            ind.big_matrix[index][elem] = ind.data[id_]["user_ratings_total"]  # Put model entries in the big matrix
+def create_individual_random(cluster, constraints, data):
+    # just like random init
+    context = ProblemContext.of(cluster, constraints, data)
+    schedules = context.locked[None].copy()
+    fill_schedules_to_max_works(context, schedules)
+    return MyIndividual(context, schedules[0])
+
+
+def create_individual_heuristic1(cluster, constraints, data):
+    context = ProblemContext.of(cluster, constraints, data)
+    return MyIndividual(context, create_schedules_heuristic1(context, 1)[0])
+
 
-        for w in ind.works[index]:
-            ind.big_matrix[index][w] = ind.data[id_]["user_ratings_total"]  # Put works entries in the big matrix
-    return ind
+def create_population_heuristic1(cluster, constraints, data, size):
+    context = ProblemContext.of(cluster, constraints, data)
+    return [MyIndividual(context, schedule) for schedule in create_schedules_heuristic1(context, size)]
 
 
 def create_individual_based_on_others_heuristic1(cluster, constraints, data, inds: list = None):
     if inds is None or len(inds) == 0:
-        ind = MyIndividual(cluster, constraints, data)
-        sundays_that_have_work = set()
-        for index, id_ in enumerate(cluster):
-            ind.works[index] = constraints[id_]["works"]
-            sundays_that_have_work.update(ind.works[index])
-            for i in range(constraints["SUNDAYS"]):
-                if i not in ind.works[index] and i not in constraints[id_]["doesnt_work"]:
-                    ind.antimodel[index].append(i)
-        for sunday in range(constraints["SUNDAYS"]):
-            if sunday in sundays_that_have_work:
+        return create_individual_heuristic1(cluster, constraints, data)
+
+    new_ind = MyIndividual(ProblemContext.of(cluster, constraints, data))
+    for other_ind in inds:
+        other_indices = other_ind.context.index
+        for index, store_id in enumerate(cluster):
+            if store_id not in other_indices:
                 continue
-            for index, id_ in enumerate(np.random.permutation(cluster)):
-                if sunday in ind.antimodel[index] and len(ind.model[index]) + len(ind.works[index]) < constraints["MAX_WORKS"]:
-                    ind.model[index].append(sunday)
-                    ind.antimodel[index].remove(sunday)
-                    ind.big_matrix[index][sunday] = data[id_]["user_ratings_total"]
-                    break
-
-        for index, id_ in enumerate(cluster):
-            while len(ind.model[index]) + len(ind.works[index]) < constraints["MAX_WORKS"]:
-                rnd = random.randint(0, len(ind.antimodel[index]) - 1)
-                elem = ind.antimodel[index][rnd]
-                ind.model[index].append(elem)
-                ind.antimodel[index].pop(rnd)
-
-                ind.big_matrix[index][elem] = ind.data[id_]["user_ratings_total"]  # Put model entries in the big matrix
-
-            for w in ind.works[index]:
-                ind.big_matrix[index][w] = ind.data[id_]["user_ratings_total"]  # Put works entries in the big matrix
-        return ind
-    else:
-        new_ind = MyIndividual(cluster, constraints, data)
-        for other_ind in inds:
-            for index, store_id in enumerate(cluster):
-                if store_id not in other_ind.cluster:
-                    continue
-                my_index = new_ind.cluster.index(store_id)
-                other_index = other_ind.cluster.index(store_id)
-                new_ind.works[my_index] = other_ind.works[other_index][::]
-                new_ind.model[my_index] = other_ind.model[other_index][::]
-                new_ind.antimodel[my_index] = other_ind.antimodel[other_index][::]
-                new_ind.big_matrix[my_index] = other_ind.big_matrix[other_index].copy()
-
-        for index, value in enumerate(new_ind.model):
-            lnt = len(value) + len(new_ind.works[index])
-            assert lnt == constraints["MAX_WORKS"], f"Model is incorrect {cluster[index]}, instead lnt is {lnt}"
-        return new_ind
+            new_ind.schedule[index] = other_ind.schedule[other_indices[store_id]]
+
+    for index, lnt in enumerate(new_ind.schedule.sum(axis=1)):
+        assert lnt == constraints["MAX_WORKS"], f"Model is incorrect {cluster[index]}, instead lnt is {lnt}"
+    return new_ind
 
 
-def mutate_individual_simple(individual, prob, count):
-    for index in range(len(individual.model)):
-        if len(individual.model[index]) == 0:
+def create_population_based_on_others_heuristic1(cluster, constraints, data, inds: list = None, size: int = 1):
+    if inds is None or len(inds) == 0:
+        return create_population_heuristic1(cluster, constraints, data, size)
+    ind = create_individual_based_on_others_heuristic1(cluster, constraints, data, inds)
+    return [ind] + [ind.copy() for _ in range(size - 1)]
+
+
+def mutate_population_simple(context, schedules, prob, count):
+    """
+    Simple mutation of a whole (population, stores, SUNDAYS) schedule array at once.
+
+    Every store of every individual is picked with probability prob and then gets count swaps of one
+    chosen Sunday with one free Sunday, so works entries, doesnt_work entries and MAX_WORKS are kept.
+    Returns a (population, SUNDAYS) mask of the changed columns.
+    """
+    free = ~context.locked
+    allowed = ~(context.locked | context.forbidden)
+    changed = np.zeros((len(schedules), context.sundays), dtype=bool)
+
+    active = (np.random.random(schedules.shape[:2]) < prob) & (schedules & free).any(axis=2)
+    for _ in range(count):
+        model = schedules & free
+        antimodel = ~schedules & allowed
+        active &= antimodel.any(axis=2)
+        ind_indices, store_indices = np.nonzero(active)
+        if len(ind_indices) == 0:
+            break
+        elems = random_pick(model[ind_indices, store_indices])
+        other_elems = random_pick(antimodel[ind_indices, store_indices])
+
+        # Swap a chosen Sunday with a free one
+        schedules[ind_indices, store_indices, elems] = False
+        schedules[ind_indices, store_indices, other_elems] = True
+        changed[ind_indices, elems] = True
+        changed[ind_indices, other_elems] = True
+    return changed
+
+
+def random_swap_moves(individual, count):
+    """
+    Draw count random moves of one store from a chosen Sunday to a free one.
+    Returns (stores, sources, targets) index arrays, empty when no store can move.
+    """
+    model, antimodel = individual.model_mask, individual.antimodel_mask
+    movable = np.flatnonzero(model.any(axis=1) & antimodel.any(axis=1))
+    if len(movable) == 0:
+        return np.zeros((3, 0), dtype=int)
+    stores = np.random.choice(movable, count)
+    return stores, random_pick(model[stores]), random_pick(antimodel[stores])
+
+
+def score_swap_moves(individual, fitness, stores, sources, targets):
+    """
+    Evaluate swap moves of an evaluated individual without applying them.
+
+    A move only changes its source and target columns, so all moves are scored by evaluating their
+    two columns in one batch. Returns the new source and target column values and the change of the
+    summed per-Sunday fitness of every move.
+    """
+    count = len(stores)
+    columns = np.concatenate([individual.schedule[:, sources].T, individual.schedule[:, targets].T])
+    columns[np.arange(count), stores] = False
+    columns[count + np.arange(count), stores] = True
+    trial = fitness.cached_columns(individual.context, columns, fitness.column_evaluator(individual.context))
+    values = individual.sunday_fitness
+    return trial[:count], trial[count:], trial[:count] + trial[count:] - values[sources] - values[targets]
+
+
+def apply_swap_moves(individual, stores, sources, targets, source_values, target_values, order):
+    """
+    Apply the scored moves in the given order, skipping moves whose columns an earlier one already changed
+    since their scores are stale. Keeps sunday_fitness and fitness up to date, returns the applied moves.
+    """
+    schedule, values = individual.schedule, individual.sunday_fitness
+    touched = set()
+    applied = []
+    for move in order:
+        if sources[move] in touched or targets[move] in touched:
             continue
-        if random.random() < prob:
-            for _ in range(count):
-                if len(individual.model[index]) == 0 or len(individual.antimodel[index]) == 0:
-                    break
-                rnd1 = random.randint(0, len(individual.model[index]) - 1)
-                rnd2 = random.randint(0, len(individual.antimodel[index]) - 1)
-                elem = individual.model[index][rnd1]
-                individual.model[index][rnd1] = individual.antimodel[index][rnd2]
-                individual.antimodel[index][rnd2] = elem
-                individual.big_matrix[index][elem] = 0  # Remove from big matrix
-                other_elem = individual.antimodel[index][rnd2]
-
-                individual.big_matrix[index][other_elem] = individual.data[individual.cluster[index]
-                                                                           # Put new entry in big matrix
-                                                                           ]["user_ratings_total"]
+        touched.update((sources[move], targets[move]))
+        schedule[stores[move], sources[move]] = False
+        schedule[stores[move], targets[move]] = True
+        values[sources[move]], values[targets[move]] = source_values[move], target_values[move]
+        applied.append(move)
+    individual.fitness = np.average(values)
+    return applied
+
+
+def local_search_swaps(individual, fitness, moves, batch):
+    """
+    Hill climbing on random swap moves, changes an evaluated individual in place.
+
+    Moves are drawn batch at a time and scored together, improving moves with disjoint columns have
+    independent deltas and are accepted together, best first. Returns the number of evaluated columns.
+    """
+    evaluated = 0
+    for start in range(0, moves, batch):
+        stores, sources, targets = random_swap_moves(individual, min(batch, moves - start))
+        if len(stores) == 0:
+            break
+        source_values, target_values, deltas = score_swap_moves(individual, fitness, stores, sources, targets)
+        evaluated += 2 * len(stores)
+        order = [move for move in np.argsort(-deltas) if deltas[move] > 1e-12]
+        apply_swap_moves(individual, stores, sources, targets, source_values, target_values, order)
+    return evaluated
+
+
+def swap_rows(c1, c2, index):
+    """Exchange the schedule of one store between two individuals."""
+    changed = np.flatnonzero(c1.schedule[index] != c2.schedule[index])
+    c1.mark_dirty(*changed)
+    c2.mark_dirty(*changed)
+    c1.schedule[index], c2.schedule[index] = c2.schedule[index].copy(), c1.schedule[index].copy()
 
 
 def crossover_individuals_kswitch(ind1, ind2, k):
     c1, c2 = ind1, ind2
-    k = min(len(ind1.model), k)
+    k = min(len(ind1.cluster), k)
 
-    indices = np.random.choice(range(len(ind1.model)), k, replace=False)
+    indices = np.random.choice(range(len(ind1.cluster)), k, replace=False)
     for index in indices:
-        if len(c1.model[index]) == 0 or len(c2.model[index]) == 0:
+        if not (c1.schedule[index] & ~c1.context.locked[index]).any():  # Nothing to exchange
             continue
-        c1.model[index], c2.model[index] = c2.model[index][::], c1.model[index][::]
-
-        # Swap rows in big matrix
-        c1.big_matrix[index], c2.big_matrix[index] = c2.big_matrix[index], c1.big_matrix[index]
-
-        c1.antimodel[index], c2.antimodel[index] = c2.antimodel[index][::], c1.antimodel[index][::]
+        swap_rows(c1, c2, index)
 
 
 def crossover_individuals_singlepoint(ind1, ind2):
     c1, c2 = ind1, ind2
-    index = random.randint(0, len(ind1.model) - 1)
-    for i in range(index, len(ind1.model)):
-        if len(c1.model[i]) == 0 or len(c2.model[i]) == 0:
+    index = random.randint(0, len(ind1.cluster) - 1)
+    for i in range(index, len(ind1.cluster)):
+        if not (c1.schedule[i] & ~c1.context.locked[i]).any():  # Nothing to exchange
             continue
-        c1.model[i], c2.model[i] = c2.model[i][::], c1.model[i][::]
-        c1.antimodel[i], c2.antimodel[i] = c2.antimodel[i][::], c1.antimodel[i][::]
-        c1.big_matrix[i], c2.big_matrix[i] = c2.big_matrix[i], c1.big_matrix[i]  # Swap rows in big matrix
+        swap_rows(c1, c2, i)
+
+
+def random_sundays(context, counts):
+    """A (pairs, SUNDAYS) mask with counts[i] distinct random Sundays chosen in row i."""
+    ranks = np.argsort(np.argsort(np.random.random((len(counts), context.sundays)), axis=1), axis=1)
+    return ranks < np.minimum(counts, context.sundays)[:, None]
+
+
+def crossover_population_columns(context, schedules1, schedules2, chosen):
+    """
+    Column exchange crossover for many pairs of (pairs, stores, SUNDAYS) schedule arrays at once.
+
+    For every chosen Sunday of a pair and every store where exactly one parent works on it, the Sunday
+    moves to the other parent. The row counts are then repaired by sampling: the receiver drops a random
+    chosen Sunday and the giver gets a random free one. Returns the changed column masks of both sides.
+    """
+    free = ~context.locked
+    allowed = ~(context.locked | context.forbidden)
+    changed1 = np.zeros(chosen.shape, dtype=bool)
+    changed2 = np.zeros(chosen.shape, dtype=bool)
+
+    def exchange(giver, receiver, giver_changed, receiver_changed, pairs, shops, sunday):
+        giver[pairs, shops, sunday] = False
+        receiver[pairs, shops, sunday] = True
+
+        # Fix them, receiver has one too many, giver has one too few
+        removes = random_pick(receiver[pairs, shops] & free[shops])
+        adds = random_pick(~giver[pairs, shops] & allowed[shops])
+        receiver[pairs, shops, removes] = False
+        giver[pairs, shops, adds] = True
+        giver_changed[pairs, sunday] = True
+        giver_changed[pairs, adds] = True
+        receiver_changed[pairs, sunday] = True
+        receiver_changed[pairs, removes] = True
+
+    for sunday in np.flatnonzero(chosen.any(axis=0)):
+        in1 = schedules1[:, :, sunday].copy()
+        differs = chosen[:, sunday, None] & (in1 != schedules2[:, :, sunday])
+        pairs, shops = np.nonzero(differs & in1)
+        exchange(schedules1, schedules2, changed1, changed2, pairs, shops, sunday)
+        pairs, shops = np.nonzero(differs & ~in1)
+        exchange(schedules2, schedules1, changed2, changed1, pairs, shops, sunday)
+    return changed1, changed2
 
 
 def crossover_individuals_columns_kswitch(ind1, ind2, k):
-    c1, c2 = ind1, ind2
-    k = min(ind1.constraints["SUNDAYS"], k)
+    context = ind1.context
+    chosen = random_sundays(context, np.array([k]))
+    changed1, changed2 = crossover_population_columns(context, ind1.schedule[None], ind2.schedule[None], chosen)
+    ind1.mark_dirty(*np.flatnonzero(changed1[0]))
+    ind2.mark_dirty(*np.flatnonzero(changed2[0]))
 
-    indices = np.random.choice(range(ind1.constraints["SUNDAYS"]), k, replace=False)
-    for index in indices:
-        sunday = index
-        for shop in range(len(c1.model)):
-            if sunday in c1.model[shop] and sunday in c2.model[shop]:
-                continue
-            if sunday not in c1.model[shop] and sunday not in c2.model[shop]:
-                continue
-            if sunday in c2.model[shop]:
-                c1, c2 = c2, c1
-            # Sunday in c1 and not in c2
-            # sunday in c1 and not in c2
-            # remove it from c1 and add to c2 models
-            # add it to c1 antimodel, remove from c2 antimodel
-            # Adjust big matrix
-            c1.model[shop].remove(sunday)
-            c2.model[shop].append(sunday)
-            c1.antimodel[shop].append(sunday)
-            c2.antimodel[shop].remove(sunday)
-            c1.big_matrix[shop][sunday] = 0  # Remove from big matrix
-            c2.big_matrix[shop][sunday] = c1.data[c1.cluster[shop]]["user_ratings_total"]  # Put new entry in big matrix
-
-            # Fix them, c2 has one too many, c1 has one too few
-            removec2 = c2.model[shop].pop(random.randint(0, len(c2.model[shop]) - 1))
-            addtoc1 = c1.antimodel[shop].pop(random.randint(0, len(c1.antimodel[shop]) - 1))
-            c1.model[shop].append(addtoc1)
-            c2.antimodel[shop].append(removec2)
-            c1.big_matrix[shop][addtoc1] = c1.data[c1.cluster[shop]
-                                                   ]["user_ratings_total"]  # Put new entry in big matrix
-            c2.big_matrix[shop][removec2] = 0  # Remove from big matrix
-
-    for index in range(len(c1.model)):
-        assert len(c1.model[index]) + len(c1.works[index]
-                                          ) == c1.constraints["MAX_WORKS"], f"Model is incorrect {c1.cluster[index]}"
-        assert len(c2.model[index]) + len(c2.works[index]
-                                          ) == c2.constraints["MAX_WORKS"], f"Model is incorrect {c2.cluster[index]}"
+    for c in (ind1, ind2):
+        for index, lnt in enumerate(c.schedule.sum(axis=1)):
+            assert lnt == context.max_works, f"Model is incorrect {c.cluster[index]}"
 
 
 class Fitness:
-    def __init__(self, *args):
+    def __init__(self, *args, cache_size=100000):
         self.args = args
 
+        # LRU cache of Sunday contributions keyed by (cluster context, bitmask of open stores)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        # Optional worker pool that evaluates cache misses, see algorithm.parallel.ColumnEvaluationPool
+        self.pool = None
+
     def __call__(self, individual):
         raise NotImplementedError("Fitness function not implemented")
 
+    def column_evaluator(self, context):
+        if self.pool is not None:
+            return lambda columns: self.pool.evaluate_columns(context, columns)
+        return lambda columns: self.evaluate_columns(context, columns)
+
+    def cache_info(self):
+        return {"hits": self.cache_hits, "misses": self.cache_misses, "size": len(self.cache)}
+
+    def cached_columns(self, context, columns, evaluate):
+        """
+        Return the contribution of each column of shape (columns, stores).
+
+        A Sunday's contribution depends only on which stores of the cluster are open, so columns
+        are looked up by their open-store bitmask and only unseen ones are passed to evaluate.
+        """
+        masks = np.packbits(columns > 0, axis=1)
+
+        values = np.empty(len(columns))
+        missing = {}
+        for index, mask in enumerate(masks):
+            key = (context, mask.tobytes())
+            value = self.cache.get(key)
+            if value is None:
+                missing.setdefault(key, []).append(index)
+            else:
+                self.cache.move_to_end(key)
+                values[index] = value
+        self.cache_misses += len(missing)
+        self.cache_hits += len(columns) - len(missing)
+
+        if len(missing) > 0:
+            first = [indices[0] for indices in missing.values()]
+            for (key, indices), value in zip(missing.items(), evaluate(columns[first])):
+                values[indices] = value
+                self.cache[key] = value
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return values
+
+    def update_sunday_fitness(self, context, schedules, sunday_fitness, needed):
+        """Recompute the needed entries of sunday_fitness (population, SUNDAYS) from the stacked schedules."""
+        ind_indices, sunday_indices = np.nonzero(needed)
+        if len(ind_indices) > 0:
+            sunday_fitness[ind_indices, sunday_indices] = self.cached_columns(
+                context, schedules[ind_indices, :, sunday_indices], self.column_evaluator(context))
+        return len(ind_indices)
+
+    def column_radii(self, context, columns):
+        """
+        Box radius of every store for each schedule column of shape (columns, stores). The populations of
+        the open stores are normalized per column, a store with all of it gets MAX_RADIUS_OF_INFLUENCE.
+        """
+        columns = columns * context.populations
+        sums = columns.sum(axis=1, keepdims=True)
+        sums[sums == 0] = 1
+        return np.sqrt(columns / sums) * MAX_RADIUS_OF_INFLUENCE
+
+    def evaluate_columns(self, context, columns):
+        raise NotImplementedError("Column evaluation not implemented")
+
 
 class IntersectUnionFitness(Fitness):
     """MAX Fitness function that calculates the average area of the union of boxes minus the intersection."""
 
-    def __init__(self, *args):
-        super().__init__(*args)
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
 
     def __call__(self, individual):
-        # Normalize each column of the big matirx
-        sums = individual.big_matrix.sum(axis=0, keepdims=True)
-        sums[sums == 0] = 1
-        solution_matrix = individual.big_matrix / sums
-        solution_matrix = np.sqrt(solution_matrix) * MAX_RADIUS_OF_INFLUENCE
+        context = individual.context
+        data_per_sunday = self.cached_columns(context, individual.schedule.T, self.column_evaluator(context))
+        individual.sunday_fitness = np.asarray(data_per_sunday)
+        individual.dirty.clear()
+        individual.fitness = np.average(data_per_sunday)
+        return (individual.fitness,)
+
+    def evaluate_columns(self, context, columns):
+        solution_matrix = self.column_radii(context, columns)
 
         data_per_sunday = []
 
-        for sunday in range(individual.constraints["SUNDAYS"]):
+        for radii in solution_matrix:
             current_sunday = []
-            for index, id_ in enumerate(individual.cluster):
-                lon, lat = individual.data[id_]["coordinates"]
-                current_sunday.append(create_box(lon, lat, solution_matrix[index][sunday]))
+            for index, (lon, lat) in enumerate(context.coordinates):
+                current_sunday.append(create_box(lon, lat, radii[index]))
 
             union, intersect = union_intersect(current_sunday)
             data_per_sunday.append(union - intersect)
-        individual.fitness = np.average(data_per_sunday)
-        return (individual.fitness,)
+        return data_per_sunday
 
 
 class FastIntersectUnionFitness(Fitness):
-    def __init__(self, *args):
-        super().__init__(*args)
-
-    def __call__(self, individual):
-        sums = individual.big_matrix.sum(axis=0, keepdims=True)
-        sums[sums == 0] = 1
-        solution_matrix = individual.big_matrix / sums
-        solution_matrix = np.sqrt(solution_matrix) * MAX_RADIUS_OF_INFLUENCE
+    # Columns with more open stores are swept one at a time, the cost of the batched grid grows with their square
+    dense_max_boxes = 64
 
-        data_per_sunday = []
-
-        for sunday in range(individual.constraints["SUNDAYS"]):
-            radii = solution_matrix[:, sunday]
-            coords = [individual.data[id_]["coordinates"] for id_ in individual.cluster]
-            boxes = fast_create_boxes(coords, radii)
-            union, intersect = fast_union_intersect(boxes)
-            data_per_sunday.append(union - intersect)
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
 
-        individual.fitness = np.average(data_per_sunday)
-        return (individual.fitness,)
+    def __call__(self, individual):
+        return self.evaluate_population([individual])[0]
+
+    def evaluate_population(self, individuals):
+        """Evaluate a list of individuals from the same cluster in one batch."""
+        if len(individuals) == 0:
+            return []
+        context = individuals[0].context
+        sundays = context.sundays
+
+        # (population, stores, SUNDAYS) tensor, columns are normalized in evaluate_columns
+        schedules = np.stack([ind.schedule for ind in individuals])
+
+        # Only Sundays changed since the last evaluation need to be recomputed
+        values = np.zeros((len(individuals), sundays))
+        needed = np.ones((len(individuals), sundays), dtype=bool)
+        for index, ind in enumerate(individuals):
+            if ind.sunday_fitness is not None:
+                values[index] = ind.sunday_fitness
+                needed[index] = False
+                needed[index, list(ind.dirty)] = True
+
+        self.update_sunday_fitness(context, schedules, values, needed)
+
+        fitnesses = []
+        for index, ind in enumerate(individuals):
+            ind.sunday_fitness = values[index]
+            ind.dirty.clear()
+            ind.fitness = np.average(values[index])
+            fitnesses.append((ind.fitness,))
+        return fitnesses
+
+    def evaluate_columns(self, context, columns):
+        """Return the union minus intersection area for each schedule column of shape (columns, stores)."""
+        radii = self.column_radii(context, columns)
+
+        # Closed stores have empty boxes, only the open ones are passed to the kernels
+        is_open = radii > 0
+        counts = is_open.sum(axis=1)
+        values = np.empty(len(radii))
+        dense = np.flatnonzero(counts <= self.dense_max_boxes)
+        if len(dense) > 0:
+            # Open stores first in every column, the columns are batched with the boxes of their widest one
+            order = np.argsort(~is_open[dense], axis=1, kind="stable")[:, :counts[dense].max()]
+            boxes = batch_create_boxes(context.x[order], context.y[order], np.take_along_axis(radii[dense], order, axis=1))
+            union, intersect = batch_union_intersect(boxes)
+            values[dense] = union - intersect
+        for index in np.flatnonzero(counts > self.dense_max_boxes):
+            stores = np.flatnonzero(is_open[index])
+            union, intersect = fast_union_intersect(batch_create_boxes(context.x[stores], context.y[stores],
+                                                                       radii[index, stores]))
+            values[index] = union - intersect
+        return values
+
+
+class SparseIntersectUnionFitness(FastIntersectUnionFitness):
+    """
+    FastIntersectUnionFitness driven by a sparse neighbour list, for clusters as large as all stores.
+
+    Boxes are at most 2 * MAX_RADIUS_OF_INFLUENCE wide, so only stores closer than that on both axes can
+    overlap. These pairs are found once per cluster context and kept on it. On every Sunday the open pairs
+    whose boxes overlap split the boxes into groups whose areas add up: a lone box counts its whole area,
+    two boxes their areas minus twice their overlap and larger groups go through util.fast_union_intersect.
+    The cost grows with the number of interacting pairs instead of with the square of the number of stores.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+    def interaction_pairs(self, context):
+        """The (first, second) pairs of the context, stored on it so they go away together."""
+        pairs = getattr(context, "neighbour_pairs", None)
+        if pairs is None:
+            pairs = context.neighbour_pairs = interaction_pairs(context.x, context.y, 2 * MAX_RADIUS_OF_INFLUENCE)
+        return pairs
+
+    def evaluate_columns(self, context, columns):
+        """Return the union minus intersection area for each schedule column of shape (columns, stores)."""
+        radii = self.column_radii(context, columns)
+
+        first, second = self.interaction_pairs(context)
+        dx = np.abs(context.x[first] - context.x[second])
+        dy = np.abs(context.y[first] - context.y[second])
+        values = np.empty(len(radii))
+        for index, r in enumerate(radii):
+            areas = (2 * r) ** 2
+            r1, r2 = r[first], r[second]
+            overlap = (r1 > 0) & (r2 > 0) & (dx < r1 + r2) & (dy < r1 + r2)
+            if not overlap.any():
+                values[index] = areas.sum()
+                continue
+            f, s = first[overlap], second[overlap]
+            labels = connected_components(f, s, len(r))
+            sizes = np.bincount(labels)[labels]
+            total = areas[sizes == 1].sum()
+
+            # Groups of two boxes share a single edge
+            pair = sizes[f] == 2
+            r1, r2 = r[f[pair]], r[s[pair]]
+            width = np.minimum(np.minimum(2 * r1, 2 * r2), r1 + r2 - dx[overlap][pair])
+            height = np.minimum(np.minimum(2 * r1, 2 * r2), r1 + r2 - dy[overlap][pair])
+            total += (areas[f[pair]] + areas[s[pair]] - 2 * width * height).sum()
+
+            large = np.flatnonzero(sizes > 2)
+            if len(large) > 0:
+                large = large[np.argsort(labels[large], kind="stable")]
+                boxes = batch_create_boxes(context.x[large], context.y[large], r[large])
+                for group in np.split(boxes, np.flatnonzero(np.diff(labels[large])) + 1):
+                    union, intersect = fast_union_intersect(group)
+                    total += union - intersect
+            values[index] = total
+        return values
 
 
 class Crossover:
@@ -310,7 +634,7 @@ class CrossoverGeometric(Crossover):
         self.p = p
 
     def __call__(self, ind1, ind2):
-        k = min(np.random.geometric(self.p), len(ind1.model) - 1)
+        k = min(np.random.geometric(self.p), len(ind1.cluster) - 1)
         crossover_individuals_kswitch(ind1, ind2, k)
 
 
@@ -325,9 +649,13 @@ class CrossoverColumnGeometric(Crossover):
         self.p = p
 
     def __call__(self, ind1, ind2):
-        k = min(np.random.geometric(self.p), len(ind1.model) - 1)
+        k = min(np.random.geometric(self.p), len(ind1.cluster) - 1)
         crossover_individuals_columns_kswitch(ind1, ind2, k)
 
+    def mate_population(self, context, schedules1, schedules2):
+        counts = np.minimum(np.random.geometric(self.p, len(schedules1)), len(context) - 1)
+        return crossover_population_columns(context, schedules1, schedules2, random_sundays(context, counts))
+
 
 class Mutator:
     def __init__(self, *args):
@@ -344,4 +672,30 @@ class MutatorSimple(Mutator):
         self.count = count
 
     def __call__(self, individual):
-        mutate_individual_simple(individual, self.prob, self.count)
+        changed = self.mutate_population(individual.context, individual.schedule[None])
+        individual.mark_dirty(*np.flatnonzero(changed[0]))
+
+    def mutate_population(self, context, schedules):
+        return mutate_population_simple(context, schedules, self.prob, self.count)
+
+
+class LocalSearch:
+    def __init__(self, *args):
+        self.args = args
+
+    def __call__(self, individual, fitness):
+        raise NotImplementedError("Local search method not implemented")
+
+
+class LocalSearchSwap(LocalSearch):
+    """Tries moves of random stores from one of their chosen Sundays to a free one, keeping the improving ones."""
+
+    def __init__(self, moves, batch=16):
+        super().__init__(moves, batch)
+        self.moves = moves
+        self.batch = batch
+
+    def __call__(self, individual, fitness):
+        if not individual.valid or individual.sunday_fitness is None:
+            fitness(individual)
+        return local_search_swaps(individual, fitness, self.moves, self.batch)
@@ -0,0 +1,128 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from multiprocessing.util import Finalize
+from types import SimpleNamespace
+import os
+import numpy as np
+
+# Fitness instance and attached shared memory blocks of a worker process, set up by init_worker
+WORKER_STATE = {}
+
+# Clusters kept in shared memory by a pool and attached by each of its workers, least recently used first
+MAX_SHARED_CONTEXTS = 16
+
+# Pools reused by all optimize_cluster calls of a process, keyed by process id, fitness type and number of workers
+POOLS = {}
+
+
+def init_worker(fitness_type):
+    WORKER_STATE["fitness"] = fitness_type()
+    WORKER_STATE["contexts"] = OrderedDict()
+
+
+def shared_context(name, stores):
+    """Rebuild the static arrays of a cluster from shared memory, attaching once per worker."""
+    contexts = WORKER_STATE["contexts"]
+    if name not in contexts:
+        # Pool workers share the parent's resource tracker, the parent unlinks the block
+        memory = SharedMemory(name=name)
+        arrays = np.ndarray((5, stores), dtype=np.float64, buffer=memory.buf)
+        contexts[name] = (memory, SimpleNamespace(x=arrays[0], y=arrays[1], populations=arrays[2],
+                                                  coordinates=arrays[3:5].T))
+        while len(contexts) > MAX_SHARED_CONTEXTS:
+            contexts.popitem(last=False)[1][0].close()
+    contexts.move_to_end(name)
+    return contexts[name][1]
+
+
+def evaluate_chunk(name, stores, packed):
+    """Evaluate bit-packed schedule columns of shape (columns, stores) against a shared cluster."""
+    columns = np.unpackbits(packed, axis=1, count=stores).astype(bool)
+    return WORKER_STATE["fitness"].evaluate_columns(shared_context(name, stores), columns)
+
+
+class ColumnEvaluationPool:
+    """
+    Worker pool that evaluates Sunday columns for a fitness object.
+
+    The static arrays of every cluster (coordinates and populations) are copied into shared memory
+    once, so tasks only carry bit-packed schedule columns and only fitness values come back.
+    Used as a context manager it installs itself as fitness.pool for the duration of the block.
+    Clusters of fewer than min_stores stores are evaluated in this process, for them sending the columns
+    costs more than evaluating them.
+    """
+
+    def __init__(self, fitness, workers, min_chunk=8, min_stores=100):
+        self.fitness = fitness
+        self.workers = workers
+        self.min_chunk = min_chunk
+        self.min_stores = min_stores
+        # Workers must inherit the resource tracker of this process, otherwise their own trackers unlink
+        # the shared blocks when they exit
+        resource_tracker.ensure_running()
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                            initargs=(type(fitness),))
+        self.shared = OrderedDict()
+
+    def share(self, context):
+        if context not in self.shared:
+            memory = SharedMemory(create=True, size=5 * len(context) * np.dtype(np.float64).itemsize)
+            arrays = np.ndarray((5, len(context)), dtype=np.float64, buffer=memory.buf)
+            arrays[0], arrays[1], arrays[2] = context.x, context.y, context.populations
+            arrays[3:5] = context.coordinates.T
+            del arrays
+            self.shared[context] = memory
+            while len(self.shared) > MAX_SHARED_CONTEXTS:
+                old_memory = self.shared.popitem(last=False)[1]
+                old_memory.close()
+                old_memory.unlink()
+        self.shared.move_to_end(context)
+        return self.shared[context].name
+
+    def evaluate_columns(self, context, columns):
+        if len(columns) < 2 * self.min_chunk or len(context) < self.min_stores:
+            return self.fitness.evaluate_columns(context, columns)
+        name = self.share(context)
+        chunks = np.array_split(columns, min(self.workers, len(columns) // self.min_chunk))
+        futures = [self.executor.submit(evaluate_chunk, name, len(context), np.packbits(chunk, axis=1))
+                   for chunk in chunks]
+        return np.concatenate([future.result() for future in futures])
+
+    def close(self):
+        self.executor.shutdown()
+        for memory in self.shared.values():
+            memory.close()
+            memory.unlink()
+        self.shared = OrderedDict()
+
+    def __enter__(self):
+        self.fitness.pool = self
+        return self
+
+    def __exit__(self, *exc):
+        self.fitness.pool = None
+        self.close()
+
+
+def shared_pool(fitness, workers):
+    """
+    The pool of this process for the type of fitness, started on first use and kept for later clusters
+    and island epochs instead of starting new workers every time. Pools are closed when the process exits.
+    """
+    # Forked processes inherit the pools of their parent, they start and close their own
+    pid = os.getpid()
+    key = (pid, type(fitness), workers)
+    if key not in POOLS:
+        if not any(owner == pid for owner, _, _ in POOLS):
+            # Before the finalizers of multiprocessing queues (priority 10), the executor still needs them
+            Finalize(None, close_pools, exitpriority=100)
+        POOLS[key] = ColumnEvaluationPool(fitness, workers)
+    return POOLS[key]
+
+
+def close_pools():
+    pid = os.getpid()
+    for key in [key for key in POOLS if key[0] == pid]:
+        POOLS.pop(key).close()
@@ -0,0 +1,145 @@
+import numpy as np
+from algorithm.models import MyIndividual
+from algorithm.stopping import EarlyStopping
+
+
+class Population:
+    """A whole GA population stored as one (population, stores, SUNDAYS) schedule array."""
+
+    def __init__(self, context, schedules, sunday_fitness=None, dirty=None):
+        self.context = context
+        self.schedules = schedules
+
+        # Per-Sunday fitness contributions and the columns changed since they were computed
+        if sunday_fitness is None:
+            sunday_fitness = np.zeros((len(schedules), context.sundays))
+            dirty = np.ones((len(schedules), context.sundays), dtype=bool)
+        self.sunday_fitness = sunday_fitness
+        self.dirty = dirty
+        self.fitness = self.sunday_fitness.mean(axis=1)
+
+    @classmethod
+    def from_individuals(cls, individuals):
+        context = individuals[0].context
+        schedules = np.stack([ind.schedule for ind in individuals])
+        population = cls(context, schedules)
+        for index, ind in enumerate(individuals):
+            if ind.sunday_fitness is not None:
+                population.sunday_fitness[index] = ind.sunday_fitness
+                population.dirty[index] = False
+                population.dirty[index, list(ind.dirty)] = True
+        return population
+
+    def __len__(self):
+        return len(self.schedules)
+
+    def take(self, indices):
+        """Clone the given members into a new population, a single copy of each array."""
+        return Population(self.context, self.schedules[indices], self.sunday_fitness[indices], self.dirty[indices])
+
+    def concat(self, other):
+        return Population(self.context, np.concatenate([self.schedules, other.schedules]),
+                          np.concatenate([self.sunday_fitness, other.sunday_fitness]),
+                          np.concatenate([self.dirty, other.dirty]))
+
+    def evaluate(self, fitness):
+        """Recompute dirty columns and return how many members had any, i.e. were evaluated again."""
+        evaluated = int(self.dirty.any(axis=1).sum())
+        fitness.update_sunday_fitness(self.context, self.schedules, self.sunday_fitness, self.dirty)
+        self.dirty[:] = False
+        self.fitness = self.sunday_fitness.mean(axis=1)
+        return evaluated
+
+    def select_tournament(self, count, tournsize):
+        """Indices of count tournament winners, all tournaments drawn at once."""
+        aspirants = np.random.randint(0, len(self), (count, tournsize))
+        return aspirants[np.arange(count), np.argmax(self.fitness[aspirants], axis=1)]
+
+    def best(self, count):
+        """Indices of the count fittest members, best first."""
+        if count <= 0:
+            return np.zeros(0, dtype=int)
+        indices = np.argpartition(-self.fitness, count - 1)[:count]
+        return indices[np.argsort(-self.fitness[indices])]
+
+    def view(self, index):
+        """An individual whose schedule is a view into the population array."""
+        return MyIndividual(self.context, self.schedules[index])
+
+    def apply(self, index, ind):
+        """Record the columns an operator changed through a view."""
+        self.dirty[index, list(ind.dirty)] = True
+
+    def individual(self, index):
+        ind = MyIndividual(self.context, self.schedules[index].copy())
+        ind.sunday_fitness = self.sunday_fitness[index].copy()
+        ind.dirty = set(np.flatnonzero(self.dirty[index]).tolist())
+        ind.fitness = self.fitness[index]
+        return ind
+
+    def individuals(self):
+        return [self.individual(index) for index in range(len(self))]
+
+
+def optimize_cluster_population(cluster, constraints, data, settings: dict = None):
+    """Structure-of-arrays version of optimize_cluster driven by the same settings dict."""
+    if "initial_population" in settings:
+        individuals = settings["initial_population"]
+    elif "create_population" in settings:
+        individuals = settings["create_population"](settings["population_size"])
+    else:
+        individuals = [settings["create_individual"]() for _ in range(settings["population_size"])]
+    population = Population.from_individuals(individuals)
+    evaluated = population.evaluate(settings["evaluate"])
+    stopping = EarlyStopping.of(settings)
+    if not stopping.history:
+        stopping.update(population.fitness.max(), evaluated)
+
+    for gen in range(settings["generations"]):
+        if stopping.reason is not None:
+            break
+        parents = population.select_tournament(len(population) - settings["elitism"], settings["tournsize"])
+        offspring = population.take(parents)
+
+        mates = 2 * np.flatnonzero(np.random.random(len(offspring) // 2) < settings["crossover_probability"])
+        if hasattr(settings["mate"], "mate_population"):
+            schedules1, schedules2 = offspring.schedules[mates], offspring.schedules[mates + 1]
+            changed1, changed2 = settings["mate"].mate_population(offspring.context, schedules1, schedules2)
+            offspring.schedules[mates], offspring.schedules[mates + 1] = schedules1, schedules2
+            offspring.dirty[mates] |= changed1
+            offspring.dirty[mates + 1] |= changed2
+        else:
+            for first in mates:
+                child1, child2 = offspring.view(first), offspring.view(first + 1)
+                settings["mate"](child1, child2)
+                offspring.apply(first, child1)
+                offspring.apply(first + 1, child2)
+
+        mutants = np.flatnonzero(np.random.random(len(offspring)) < settings["mutation_probability"])
+        if hasattr(settings["mutate"], "mutate_population"):
+            schedules = offspring.schedules[mutants]
+            offspring.dirty[mutants] |= settings["mutate"].mutate_population(offspring.context, schedules)
+            offspring.schedules[mutants] = schedules
+        else:
+            for index in mutants:
+                mutant = offspring.view(index)
+                settings["mutate"](mutant)
+                offspring.apply(index, mutant)
+
+        evaluated = offspring.evaluate(settings["evaluate"])
+        population = population.take(population.best(settings["elitism"])).concat(offspring)
+
+        # Memetic step, polish the best members in place through views of the population arrays,
+        # its evaluated columns count as 1/SUNDAYS of a member each
+        if settings.get("local_search") is not None:
+            for index in population.best(settings.get("local_search_elites", 1)):
+                elite = population.view(index)
+                elite.sunday_fitness, elite.fitness = population.sunday_fitness[index], population.fitness[index]
+                evaluated += settings["local_search"](elite, settings["evaluate"]) / population.context.sundays
+                population.fitness[index] = elite.fitness
+        print("Best fitness:", population.fitness[population.best(1)[0]])
+        stopping.update(population.fitness.max(), evaluated)
+
+    individuals = population.individuals()
+    best_individual = individuals[population.best(1)[0]]
+    return individuals, best_individual, stopping.report()
@@ -0,0 +1,100 @@
+import math
+import time
+
+
+class GenerationScheduler:
+    """
+    Splits the budget of a whole dispatcher run over its meta steps and clusters.
+
+    The budget is a number of evaluations, as counted by algorithm.stopping.EarlyStopping, and/or seconds
+    of wall-clock time. Every meta step gets the share plan[step] / sum(plan[step:]) of what is left of it,
+    plan[step:] cut to the estimated number of remaining meta steps, so budget a step does not use is
+    moved to the later ones. Within a step every cluster gets budget in proportion to its size times the
+    improvement per evaluation its stores showed in their last runs, so converged clusters get less.
+    Without any budget the generations of the plan are used as they are.
+    """
+
+    def __init__(self, plan, evaluations=None, seconds=None, workers=1, population_size=50, join_amount=3,
+                 min_generations=2, min_rate=0.1):
+        self.plan = plan
+        self.evaluations = evaluations
+        self.seconds = seconds
+        self.workers = workers
+        self.join_amount = join_amount
+        self.min_generations = min_generations
+        self.min_rate = min_rate
+
+        self.used_evaluations = 0
+        self.used_seconds = 0.0
+        self.generations_run = 0
+        self.evaluations_per_generation = population_size
+        self.rates = {}  # Relative improvement per evaluation of the last run including the store
+        self.allocations = []  # Per meta step, cluster index -> allocation and what the run used of it
+        self.restart_clock()
+
+    def restart_clock(self):
+        """Only time spent while running counts, call again after resuming from a checkpoint."""
+        self.clock = time.time()
+
+    def generations(self, step):
+        return self.plan[min(step, len(self.plan) - 1)]
+
+    def step_share(self, step, clusters):
+        steps_left = max(1, math.ceil(math.log(max(len(clusters), 1)) / math.log(self.join_amount)) + 1)
+        return self.generations(step) / sum(self.generations(step + offset) for offset in range(steps_left))
+
+    def allocate(self, step, clusters, tasks):
+        """Budget of every task of a meta step: its generations, max_evaluations and time_budget."""
+        rates = {index: sum(self.rates.get(store_id, 1.0) for store_id in clusters[index]) / len(clusters[index])
+                 for index in tasks}
+        top_rate = max(rates.values(), default=0)
+        weights = {index: len(clusters[index]) * max(rates[index] / top_rate if top_rate > 0 else 1, self.min_rate)
+                   for index in tasks}
+        total_weight = sum(weights.values())
+        share = self.step_share(step, clusters)
+
+        allocation = {}
+        for index in tasks:
+            fraction = weights[index] / total_weight
+            budget = {"size": len(clusters[index]), "generations": self.generations(step),
+                      "max_evaluations": None, "time_budget": None}
+            if self.evaluations is not None:
+                evaluations = max(self.evaluations - self.used_evaluations, 0) * share * fraction
+                generations = int(evaluations / self.evaluations_per_generation)
+                budget["generations"] = min(max(generations, self.min_generations), self.generations(0))
+                budget["max_evaluations"] = evaluations
+            if self.seconds is not None:
+                step_seconds = max(self.seconds - self.used_seconds, 0) * share
+                parallel = min(self.workers, len(tasks))
+                budget["time_budget"] = min(step_seconds * parallel * fraction, step_seconds)
+                if self.evaluations is None:
+                    budget["generations"] = self.generations(0)
+            allocation[index] = budget
+        self.allocations.append(allocation)
+        return allocation
+
+    def record(self, cluster, report, budget):
+        """Account for a finished run and remember how much its stores were still improving."""
+        now = time.time()
+        self.used_seconds += now - self.clock
+        self.clock = now
+        self.used_evaluations += report["evaluations"]
+        self.generations_run += report["generations"]
+        if self.generations_run > 0:
+            self.evaluations_per_generation = max(self.used_evaluations / self.generations_run, 1)
+
+        initial = report["initial_fitness"]
+        rate = (report["best_fitness"] - initial) / max(abs(initial), 1e-12) / max(report["evaluations"], 1)
+        for store_id in cluster:
+            self.rates[store_id] = max(rate, 0.0)
+        budget.update(used_generations=report["generations"], used_evaluations=report["evaluations"],
+                      used_seconds=report["elapsed"], reason=report["reason"])
+
+    def summary(self):
+        return {
+            "evaluations": self.evaluations,
+            "seconds": self.seconds,
+            "used_evaluations": self.used_evaluations,
+            "used_seconds": self.used_seconds,
+            "steps": [{str(index): budget for index, budget in allocation.items()} for allocation in self.allocations],
+        }
@@ -0,0 +1,65 @@
+import time
+
+
+class EarlyStopping:
+    """
+    Decides when a run of optimize_cluster can stop before settings["generations"].
+
+    All criteria are optional settings:
+    - "stagnation_generations": stop when the best fitness improved by at most "min_improvement"
+      (relative, default 0) over that many generations
+    - "max_evaluations": stop once that many individuals were evaluated
+    - "time_budget": stop after that many seconds of wall-clock time
+    A tracker passed as settings["stopping"] is continued instead, e.g. across the epochs of an island.
+    """
+
+    def __init__(self, settings):
+        self.stagnation_generations = settings.get("stagnation_generations")
+        self.min_improvement = settings.get("min_improvement", 0.0)
+        self.max_evaluations = settings.get("max_evaluations")
+        self.time_budget = settings.get("time_budget")
+        self.start = time.time()
+        self.evaluations = 0
+        # Best fitness and number of individuals evaluated for the initial population and every generation
+        self.history = []
+        self.evaluation_history = []
+        self.reason = None
+
+    @classmethod
+    def of(cls, settings):
+        return settings["stopping"] if settings.get("stopping") is not None else cls(settings)
+
+    @property
+    def generations(self):
+        return max(len(self.history) - 1, 0)
+
+    def elapsed(self):
+        return time.time() - self.start
+
+    def update(self, best_fitness, evaluations):
+        """Record the initial population or a finished generation, return the stop reason or None."""
+        self.history.append(float(best_fitness))
+        self.evaluation_history.append(evaluations)
+        self.evaluations += evaluations
+        window = self.stagnation_generations
+        if window is not None and len(self.history) > window:
+            previous = self.history[-window - 1]
+            if (self.history[-1] - previous) / max(abs(previous), 1e-12) <= self.min_improvement:
+                self.reason = "stagnation"
+        if self.max_evaluations is not None and self.evaluations >= self.max_evaluations:
+            self.reason = "max_evaluations"
+        if self.time_budget is not None and self.elapsed() >= self.time_budget:
+            self.reason = "time_budget"
+        return self.reason
+
+    def report(self):
+        """Why and when the run stopped, "generations" when it ran all of settings["generations"]."""
+        return {
+            "reason": self.reason or "generations",
+            "generations": self.generations,
+            "evaluations": self.evaluations,
+            "evaluations_per_generation": self.evaluation_history[1:],
+            "initial_fitness": self.history[0] if self.history else None,
+            "best_fitness": self.history[-1] if self.history else None,
+            "elapsed": self.elapsed(),
+        }
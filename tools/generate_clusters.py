@@ -1,38 +1,52 @@
 import os
 import json
-from util import load_json, store_json, haversine
+import numpy as np
+from util import load_json, store_json, haversine_neighbours, neighbour_lists
 import random
 
 
 def make_clusters(data, max_in_cluster=5, max_distance=3):
+    """
+    Greedily split the stores into clusters of at most max_in_cluster stores. Every cluster starts from a
+    random remaining store and keeps taking the remaining store closest to any of its members while that
+    one is closer than max_distance kilometers.
+
+    The neighbours within max_distance of every store are listed once up front, every new member only adds
+    its own remaining neighbours to the distances of the cluster instead of comparing all pairs of stores.
+    """
+    ids = list(data.keys())
+    lon, lat = np.array([data[id_]["coordinates"] for id_ in ids], dtype=float).reshape(-1, 2).T
+    indptr, neighbours, distances = neighbour_lists(haversine_neighbours(lat, lon, max_distance), len(ids))
+    remaining = np.ones(len(ids), dtype=bool)
+    left = len(ids)
+
     clusters = []
-    data = data.copy()
-    while len(data) > 0:
-        cluster = []
-        cluster.append(list(data.keys())[random.randint(0, len(data) - 1)])
-
-        while len(cluster) < max_in_cluster and len(data) > 0:
-            # find closest store to cluster
-            closest = None
-            closest_distance = float("inf")
-            for dude in cluster:
-                for other in data.keys():
-                    if dude == other or other in cluster:
-                        continue
-                    distance = haversine(data[dude]["coordinates"][1], data[dude]["coordinates"][0],
-                                         data[other]["coordinates"][1], data[other]["coordinates"][0])
-                    if distance < closest_distance:
-                        closest_distance = distance
-                        closest = other
-            if closest_distance < max_distance:
+    while left > 0:
+        first = np.flatnonzero(remaining)[random.randint(0, left - 1)]
+        cluster = [first]
+        remaining[first] = False
+        left -= 1
+
+        # Distance from every candidate to the closest member of the cluster
+        closest_distances = {}
+        while len(cluster) < max_in_cluster and left > 0:
+            start, end = indptr[cluster[-1]], indptr[cluster[-1] + 1]
+            for other, distance in zip(neighbours[start:end].tolist(), distances[start:end].tolist()):
+                if remaining[other] and distance < closest_distances.get(other, float("inf")):
+                    closest_distances[other] = distance
+            if len(closest_distances) == 0:
+                break
+            closest = min(closest_distances, key=lambda other: (closest_distances[other], other))
+            if closest_distances.pop(closest) < max_distance:
                 cluster.append(closest)
+                remaining[closest] = False
+                left -= 1
             else:
                 break
+        cluster = [ids[index] for index in cluster]
         print(data[cluster[0]]["formatted_address"])
         print(cluster)
         clusters.append(cluster)
-        for dude in cluster:
-            del data[dude]
     return clusters
 
 
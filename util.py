@@ -1,5 +1,6 @@
 import os
 import json
+import pickle
 import datetime
 import matplotlib.pyplot as plt
 from math import radians, sin, cos, sqrt, atan2
@@ -26,6 +27,25 @@ def store_json(data, file_path):
         json.dump(data, file, ensure_ascii=False, indent=4)
 
 
+def store_pickle(data, file_path):
+    """Pickle data to a file atomically, readers see either the old or the new file, never a partial one."""
+    temp_path = f"{file_path}.tmp"
+    with open(temp_path, 'wb') as file:
+        pickle.dump(data, file, protocol=pickle.HIGHEST_PROTOCOL)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, file_path)
+
+
+def load_pickle(file_path):
+    """Load a file stored by store_pickle."""
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"File not found: {file_path}")
+
+    with open(file_path, 'rb') as file:
+        return pickle.load(file)
+
+
 def count_sundays(year):
     sundays = 0
     for month in range(1, 13):
@@ -115,6 +135,151 @@ def haversine(lat1, lon1, lat2, lon2):
     return distance_km
 
 
+def haversine_one_to_many(lat, lon, lats, lons):
+    """haversine from one point to arrays of points, lat and lon may also be arrays broadcasting against them."""
+    R = 6371.0  # Earth radius in kilometers
+
+    dlat = np.radians(np.subtract(lats, lat))
+    dlon = np.radians(np.subtract(lons, lon))
+
+    a = np.sin(dlat / 2)**2 + np.cos(np.radians(lat)) * np.cos(np.radians(lats)) * np.sin(dlon / 2)**2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return R * c
+
+
+def haversine_many_to_many(lats1, lons1, lats2, lons2):
+    """(n, m) matrix of haversine distances between n and m points, for blocks that fit in memory."""
+    return haversine_one_to_many(np.asarray(lats1)[:, None], np.asarray(lons1)[:, None], lats2, lons2)
+
+
+def haversine_within(lats, lons, radius, max_block=2**22):
+    """
+    Stream all pairs of points within radius kilometers, each once, as (first, second, distances) arrays
+    with first < second. Never builds the full distance matrix, see SpatialGrid.pairs.
+    """
+    return SpatialGrid(lats, lons, radius).pairs(max_block)
+
+
+def haversine_neighbours(lats, lons, radius, max_block=2**22):
+    """All pairs of points within radius kilometers as (first, second, distances) arrays, see haversine_within."""
+    blocks = list(haversine_within(lats, lons, radius, max_block))
+    if len(blocks) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+    return tuple(np.concatenate(arrays) for arrays in zip(*blocks))
+
+
+def neighbour_lists(pairs, n):
+    """
+    Turn (first, second, distances) pairs into per point neighbour lists: the neighbours of point i and
+    their distances are neighbours[indptr[i]:indptr[i + 1]] and distances[indptr[i]:indptr[i + 1]].
+    """
+    first, second, distances = pairs
+    sources = np.concatenate([first, second])
+    order = np.argsort(sources, kind="stable")
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(sources, minlength=n))
+    return indptr, np.concatenate([second, first])[order], np.concatenate([distances, distances])[order]
+
+
+def grid_cells(keys):
+    """Map every distinct row of integer cell keys to the indices of the points in that cell."""
+    cells, inverse = np.unique(keys, axis=0, return_inverse=True)
+    order = np.argsort(inverse.ravel(), kind="stable")
+    bounds = np.cumsum(np.bincount(inverse.ravel(), minlength=len(cells)))[:-1]
+    return {tuple(cell): members for cell, members in zip(cells.tolist(), np.split(order, bounds))}
+
+
+def interaction_pairs(x, y, reach):
+    """
+    Pairs of projected points with |dx| < reach and |dy| < reach, each once as (first, second) arrays with
+    first < second. Boxes of half-width below reach / 2 around two points can only overlap for such pairs.
+    """
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    cells = grid_cells(np.floor(np.stack([x, y], axis=1) / reach).astype(np.int64))
+    firsts, seconds = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    for (cx, cy), members in cells.items():
+        # Pairs in the same cell and in the four following neighbour cells, so every pair is found once
+        for dx, dy in ((0, 0), (1, -1), (1, 0), (1, 1), (0, 1)):
+            others = cells.get((cx + dx, cy + dy))
+            if others is None:
+                continue
+            close = (np.abs(x[members][:, None] - x[others]) < reach) & (np.abs(y[members][:, None] - y[others]) < reach)
+            if dx == 0 and dy == 0:
+                close &= members[:, None] < others[None, :]
+            rows, columns = np.nonzero(close)
+            first, second = members[rows], others[columns]
+            firsts.append(np.minimum(first, second))
+            seconds.append(np.maximum(first, second))
+    return np.concatenate(firsts), np.concatenate(seconds)
+
+
+def connected_components(first, second, n):
+    """Component label 0..k-1 of each of n points given the edges between them."""
+    parent = np.arange(n)
+    while True:
+        # Hook the root of the higher label onto the lower one, then compress all paths to roots
+        a, b = parent[first], parent[second]
+        low, high = np.minimum(a, b), np.maximum(a, b)
+        differ = low != high
+        if not differ.any():
+            break
+        np.minimum.at(parent, high[differ], low[differ])
+        while True:
+            grand = parent[parent]
+            if np.array_equal(grand, parent):
+                break
+            parent = grand
+    return np.unique(parent, return_inverse=True)[1].ravel()
+
+
+class SpatialGrid:
+    """
+    Uniform grid over stores mapped onto the unit sphere, for queries of the stores within radius kilometers.
+
+    The chord between two points on the sphere grows with their great-circle distance, so with cells as wide
+    as the chord of radius every store within radius of a point lies in the 27 cells around it.
+    """
+
+    OFFSETS = np.array([(dx, dy, dz) for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)])
+
+    def __init__(self, lat, lon, radius):
+        R = 6371.0  # Earth radius in kilometers
+        self.lat = np.asarray(lat, dtype=float)
+        self.lon = np.asarray(lon, dtype=float)
+        self.radius = radius
+        self.cell_size = 2 * np.sin(min(radius / (2 * R), np.pi / 2))
+
+        lat_rad, lon_rad = np.radians(self.lat), np.radians(self.lon)
+        points = np.stack([np.cos(lat_rad) * np.cos(lon_rad), np.cos(lat_rad) * np.sin(lon_rad), np.sin(lat_rad)], axis=1)
+        self.keys = np.floor(points / self.cell_size).astype(np.int64)
+        self.cells = grid_cells(self.keys)
+
+    def __len__(self):
+        return len(self.lat)
+
+    def around(self, key):
+        """Indices of the stores in the 27 cells around the cell with the given key."""
+        found = [self.cells.get(tuple(cell)) for cell in (np.asarray(key) + self.OFFSETS).tolist()]
+        return np.concatenate([members for members in found if members is not None])
+
+    def pairs(self, max_block=2**22):
+        """
+        Stream all pairs of stores within radius, each once, as (first, second, distances) arrays with
+        first < second. Distances are computed per cell against the cells around it, in blocks of at most
+        max_block distances, so memory stays bounded however many stores there are.
+        """
+        for key, members in self.cells.items():
+            candidates = self.around(key)
+            step = max(1, max_block // len(candidates))
+            for start in range(0, len(members), step):
+                block = members[start:start + step]
+                distances = haversine_many_to_many(self.lat[block], self.lon[block],
+                                                   self.lat[candidates], self.lon[candidates])
+                rows, columns = np.nonzero((distances <= self.radius) & (block[:, None] < candidates[None, :]))
+                if len(rows) > 0:
+                    yield block[rows], candidates[columns], distances[rows, columns]
+
+
 def latlon_to_xy(lat, lon, lat0=45.10000, lon0=15.2000):
     """Convert latitude and longitude to x, y coordinates."""
     R = 6371.0  # Earth radius in kilometers
@@ -150,6 +315,63 @@ def fast_create_boxes(coords, radii):
     return res  # [x_min, y_min, x_max, y_max]
 
 
+def batch_create_boxes(x, y, radii):
+    """
+    Create boxes for every store on every Sunday at once.
+
+    Args:
+        x, y: numpy arrays of shape (n,) with projected store coordinates
+        radii: numpy array of shape (..., n) with a radius per store
+
+    Returns:
+        numpy array of shape (..., n, 4) where each row is [x_min, y_min, x_max, y_max]
+    """
+    return np.stack([x - radii, y - radii, x + radii, y + radii], axis=-1)
+
+
+def batch_union_intersect(boxes, max_cells=2**22):
+    """
+    Calculate union and intersection areas for many independent sets of boxes at once.
+
+    Every set is compressed onto the grid spanned by its own box edges. The number of boxes
+    covering each grid cell is computed as a batched product of the x and y coverage masks,
+    which gives the exact union area and the exact area covered by at least two boxes.
+    Sets are processed in chunks so that at most max_cells grid cells are alive at a time.
+
+    Args:
+        boxes: numpy array of shape (..., n, 4) where each row is [x1, y1, x2, y2]
+        max_cells: upper bound on the number of grid cells processed in one chunk
+
+    Returns:
+        tuple: (union_area, intersect_area), both numpy arrays of shape (...)
+    """
+    batch_shape = boxes.shape[:-2]
+    n = boxes.shape[-2]
+    if n == 0:
+        return np.zeros(batch_shape), np.zeros(batch_shape)
+    boxes = boxes.reshape(-1, n, 4)
+    union = np.zeros(len(boxes))
+    intersect = np.zeros(len(boxes))
+
+    chunk = max(1, max_cells // (4 * n * n))
+    for start in range(0, len(boxes), chunk):
+        part = boxes[start:start + chunk]
+        xs = np.sort(np.concatenate([part[:, :, 0], part[:, :, 2]], axis=1), axis=1)
+        ys = np.sort(np.concatenate([part[:, :, 1], part[:, :, 3]], axis=1), axis=1)
+        mid_x = (xs[:, 1:] + xs[:, :-1]) / 2
+        mid_y = (ys[:, 1:] + ys[:, :-1]) / 2
+
+        # (batch, boxes, cells) masks telling which box covers which column / row of the grid
+        cover_x = (part[:, :, 0, None] <= mid_x[:, None, :]) & (mid_x[:, None, :] < part[:, :, 2, None])
+        cover_y = (part[:, :, 1, None] <= mid_y[:, None, :]) & (mid_y[:, None, :] < part[:, :, 3, None])
+        counts = np.matmul(cover_y.transpose(0, 2, 1).astype(np.float32), cover_x.astype(np.float32))
+
+        cell_area = np.diff(ys, axis=1)[:, :, None] * np.diff(xs, axis=1)[:, None, :]
+        union[start:start + chunk] = np.where(counts >= 1, cell_area, 0).sum(axis=(1, 2))
+        intersect[start:start + chunk] = np.where(counts >= 2, cell_area, 0).sum(axis=(1, 2))
+    return union.reshape(batch_shape), intersect.reshape(batch_shape)
+
+
 def union_intersect(boxes):
     """Calculate the total overlapping area of a list of boxes."""
 
@@ -165,148 +387,111 @@ def union_intersect(boxes):
     return (union.area if union else 0, intersect.area if intersect else 0)
 
 
+class _CoverageTree:
+    """Segment tree over elementary y intervals that tracks the length covered at least once and twice."""
+
+    def __init__(self, ys):
+        self.ys = ys
+        size = 4 * max(len(ys) - 1, 1)
+        self.count = [0] * size
+        self.len1 = [0.0] * size
+        self.len2 = [0.0] * size
+
+    def update(self, lo, hi, delta, node=1, left=0, right=None):
+        """Add delta to the coverage of elementary intervals [lo, hi)."""
+        if right is None:
+            right = len(self.ys) - 1
+        if hi <= left or right <= lo:
+            return
+        if lo <= left and right <= hi:
+            self.count[node] += delta
+        else:
+            middle = (left + right) // 2
+            self.update(lo, hi, delta, 2 * node, left, middle)
+            self.update(lo, hi, delta, 2 * node + 1, middle, right)
+        self._pull(node, left, right)
+
+    def _pull(self, node, left, right):
+        count = self.count[node]
+        length = self.ys[right] - self.ys[left]
+        leaf = right - left == 1
+        if count >= 2:
+            self.len1[node] = length
+            self.len2[node] = length
+        elif count == 1:
+            self.len1[node] = length
+            self.len2[node] = 0.0 if leaf else self.len1[2 * node] + self.len1[2 * node + 1]
+        elif leaf:
+            self.len1[node] = 0.0
+            self.len2[node] = 0.0
+        else:
+            self.len1[node] = self.len1[2 * node] + self.len1[2 * node + 1]
+            self.len2[node] = self.len2[2 * node] + self.len2[2 * node + 1]
+
+
 def fast_union_intersect(boxes):
     """
     Calculate the total union and intersection area of a list of boxes using a sweep line algorithm.
     Matches the output of the original Shapely implementation with algebraic accuracy.
 
+    The sweep moves along x and keeps a coverage-count segment tree over the compressed y edges,
+    so the exact union area and the exact area covered by at least two boxes are found in O(n log n).
+
     Args:
         boxes: numpy array of shape (n, 4) where each row is [x1, y1, x2, y2]
 
     Returns:
         tuple: (union_area, intersect_area)
     """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    boxes = boxes[(boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])]  # Empty boxes cover nothing
     if len(boxes) == 0:
         return 0.0, 0.0
-
-    # First, calculate all pairwise intersections
-    intersections = []
-    for i in range(len(boxes)):
-        for j in range(i + 1, len(boxes)):
-            box1 = boxes[i]
-            box2 = boxes[j]
-
-            # Calculate intersection coordinates
-            x1 = max(box1[0], box2[0])
-            y1 = max(box1[1], box2[1])
-            x2 = min(box1[2], box2[2])
-            y2 = min(box1[3], box2[3])
-
-            # Check if intersection exists
-            if x2 > x1 and y2 > y1:
-                # Store intersection box
-                intersections.append([x1, y1, x2, y2])
-
-    # Create a list of all rectangles (original boxes and their intersections)
-    all_rects = []
-    for box in boxes:
-        all_rects.append(("box", box))
-
-    for inter in intersections:
-        all_rects.append(("intersection", np.array(inter)))
-
-    # If no intersections, just sum the box areas for union
-    if not intersections:
-        box_areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
-        union_area = np.sum(box_areas)
-        return union_area, 0.0
-
-    # Function to calculate area using inclusion-exclusion principle
-    def calculate_areas():
-        # 1. Calculate area of each original box
-        box_areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
-        total_box_area = np.sum(box_areas)
-
-        # 2. Calculate area of each intersection
-        intersection_areas = np.array([(box[2] - box[0]) * (box[3] - box[1]) for box in intersections])
-        total_intersection_area = np.sum(intersection_areas)
-
-        # 3. Calculate area of overlaps between intersections (for inclusion-exclusion)
-        # This is where we need to handle multiple overlapping regions carefully
-
-        # Create all unique x and y coordinates for a segment tree / sweep line
-        x_coords = set()
-        y_coords = set()
-
-        for box in boxes:
-            x_coords.add(box[0])
-            x_coords.add(box[2])
-            y_coords.add(box[1])
-            y_coords.add(box[3])
-
-        x_coords = sorted(list(x_coords))
-        y_coords = sorted(list(y_coords))
-
-        # Map coordinates to indices
-        x_map = {coord: i for i, coord in enumerate(x_coords)}
-        y_map = {coord: i for i, coord in enumerate(y_coords)}
-
-        # Create a 2D grid to track overlap counts
-        width = len(x_coords)
-        height = len(y_coords)
-        grid = np.zeros((height, width), dtype=int)
-
-        # Fill the grid with box overlaps
-        for box in boxes:
-            x1_idx = x_map[box[0]]
-            y1_idx = y_map[box[1]]
-            x2_idx = x_map[box[2]]
-            y2_idx = y_map[box[3]]
-
-            # Mark grid cells covered by this box
-            for y in range(y1_idx, y2_idx):
-                for x in range(x1_idx, x2_idx):
-                    grid[y, x] += 1
-
-        # Calculate exact areas using the grid and actual coordinates
-        union_area = 0
-        intersect_area = 0
-
-        for y in range(height - 1):
-            for x in range(width - 1):
-                cell_count = grid[y, x]
-                if cell_count > 0:
-                    # Calculate exact cell area
-                    cell_width = x_coords[x + 1] - x_coords[x]
-                    cell_height = y_coords[y + 1] - y_coords[y]
-                    cell_area = cell_width * cell_height
-
-                    # Add to union area
-                    union_area += cell_area
-
-                    # Add to intersection area if covered by 2+ boxes
-                    if cell_count >= 2:
-                        intersect_area += cell_area
-
-        return union_area, intersect_area
-
-    # Calculate results with algebraic precision
-    union_area, intersect_area = calculate_areas()
+    if len(boxes) == 1:
+        return float((boxes[0, 2] - boxes[0, 0]) * (boxes[0, 3] - boxes[0, 1])), 0.0
+
+    ys = np.unique(boxes[:, [1, 3]])
+    lows = np.searchsorted(ys, boxes[:, 1]).tolist()
+    highs = np.searchsorted(ys, boxes[:, 3]).tolist()
+
+    events = [(x1, 1, lo, hi) for x1, lo, hi in zip(boxes[:, 0].tolist(), lows, highs)]
+    events += [(x2, -1, lo, hi) for x2, lo, hi in zip(boxes[:, 2].tolist(), lows, highs)]
+    events.sort()
+
+    tree = _CoverageTree(ys.tolist())
+    union_area = 0.0
+    intersect_area = 0.0
+    previous_x = events[0][0]
+    for x, delta, lo, hi in events:
+        width = x - previous_x
+        if width > 0:
+            union_area += tree.len1[1] * width
+            intersect_area += tree.len2[1] * width
+            previous_x = x
+        tree.update(lo, hi, delta)
     return union_area, intersect_area
 
 
 def individual_to_json(ind):
     sol = {}
     for i, id_ in enumerate(ind.cluster):
-        sol[id_] = ind.works[i] + ind.model[i]
-        sol[id_] = list(map(int, sol[id_]))
+        sol[id_] = np.flatnonzero(ind.schedule[i]).tolist()
     return sol
 
 
 def load_individual_from_json(file_path):
-    from algorithm.models import MyIndividual
+    from algorithm.models import MyIndividual, ProblemContext
     constraints = load_json("data/constraints.json")
     data = load_json("data/rawdata.json")
     with open(file_path, 'r', encoding="utf-8") as file:
         ind = json.load(file)
         cluster = list(ind.keys())
-        works = [ind[id_] for id_ in cluster]
-
-        new_ind = MyIndividual(cluster, constraints, data)
-        new_ind.works = works
-        new_ind.model = [0] * len(cluster)
-        new_ind.big_matrix = np.zeros((len(cluster), constraints["SUNDAYS"]))
-        for index, row in enumerate(works):
-            for item in row:
-                new_ind.big_matrix[index][item] = data[cluster[index]]["user_ratings_total"]
+
+        # A stored solution is fixed, every working Sunday is treated as a works entry
+        fixed = {"SUNDAYS": constraints["SUNDAYS"], "MAX_WORKS": constraints["MAX_WORKS"]}
+        for id_ in cluster:
+            fixed[id_] = {"works": ind[id_], "doesnt_work": []}
+
+        new_ind = MyIndividual(ProblemContext(cluster, fixed, data))  # fixed is built per call, nothing to share
+        new_ind.schedule[:] = new_ind.context.locked
     return new_ind